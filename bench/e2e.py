@@ -0,0 +1,181 @@
+"""End-to-end benchmark of update, fetch and checkout against a local mock Stud.IP server.
+
+Each configuration runs the real client in a fresh sync directory, once with an empty cache and
+optionally a second time with nothing to do. Timings are taken from the client's --trace output.
+Run from the repository root, e.g.
+
+    python3 -m bench.e2e --courses 20 --files 50 --latency 0.02 --update-concurrency 1,4,8
+"""
+
+import argparse, itertools, json, os, shutil, subprocess, sys, tempfile, time
+
+from base64 import b64encode
+from os import path
+
+from studip.config import Config
+from studip.util import encrypt_password
+
+from .mockserver import MockStudip
+
+
+CLIENT = path.join(path.dirname(path.dirname(path.abspath(__file__))), "studip.py")
+
+
+def comma_list(type):
+    return lambda value: [ type(v) for v in value.split(",") ]
+
+
+def prepare_sync_dir(work_dir, mock, backend, update_concurrency, fetch_concurrency):
+    """Creates a home directory with a login secret and a sync directory whose configuration
+    points to the mock server. Returns the environment to run the client with."""
+    home = path.join(work_dir, "home")
+    env = dict(os.environ, HOME=home, XDG_CACHE_HOME=path.join(home, ".cache"))
+
+    # Where appdirs looks for the cache on Linux and macOS, respectively
+    secret = os.urandom(50)
+    for cache_dir in [ path.join(home, ".cache", "studip"),
+            path.join(home, "Library", "Caches", "studip") ]:
+        os.makedirs(cache_dir)
+        with open(path.join(cache_dir, "secret"), "wb") as file:
+            file.write(b64encode(secret) + b"\n")
+
+    dot_dir = path.join(work_dir, "sync", ".studip")
+    os.makedirs(dot_dir)
+    config = Config(path.join(dot_dir, "studip.conf"))
+    config["server", "studip_base"] = mock.base_url
+    config["server", "sso_base"] = mock.base_url
+    config["connection", "backend"] = backend
+    config["connection", "update_concurrency"] = update_concurrency
+    config["connection", "fetch_concurrency"] = fetch_concurrency
+    config["user", "user_name"] = "benchmark"
+    config["user", "password"] = encrypt_password(secret, "benchmark")
+    config["user", "save_login"] = "yes"
+    config.write()
+    return env
+
+
+def run_client(work_dir, env, mock, name):
+    """Runs studip sync and returns its trace, None if the client failed."""
+    trace_file = path.join(work_dir, name + ".json")
+    # Every new course is confirmed with the default answer
+    answers = "\n" * (len(mock.courses) + 1)
+    start = time.perf_counter()
+    result = subprocess.run([ sys.executable, CLIENT, "sync", "-d", path.join(work_dir, "sync"),
+            "--trace", trace_file ], input=answers.encode(), env=env, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    wall_time = time.perf_counter() - start
+
+    if result.returncode != 0:
+        output = result.stdout.decode(errors="replace").strip().splitlines()
+        sys.stderr.write("Client failed with exit code {}:\n  {}\n".format(result.returncode,
+                "\n  ".join(output[-10:])))
+        return None
+
+    with open(trace_file, "r", encoding="utf-8") as file:
+        trace = json.load(file)
+    trace["wall_time"] = wall_time
+    return trace
+
+
+def summarize(trace, mock):
+    """Derives per-phase throughput from a trace."""
+    phases = dict((p["name"], p["duration"]) for p in trace["phases"])
+    requests = trace["request_stats"]
+    downloaded = requests.get("sendfile", {}).get("bytes", 0)
+
+    def rate(count, phase):
+        return count / phases[phase] if phases.get(phase) else 0
+
+    details = requests.get("detail", {}).get("count", 0)
+    return {
+        "wall_time": trace["wall_time"],
+        "phases": phases,
+        "update_files_per_s": rate(details, "update"),
+        "fetch_files_per_s": rate(requests.get("sendfile", {}).get("count", 0), "fetch"),
+        "fetch_mb_per_s": rate(downloaded / 1e6, "fetch"),
+        "checkout_files_per_s": rate(trace["syscalls"].get("link", 0), "checkout"),
+        "latency": dict((kind, { "mean": s["mean"], "p95": s["p95"], "count": s["count"] })
+                for kind, s in requests.items()),
+        "db_statements": sum(trace["db_statements"].values()),
+        "syscalls": sum(trace["syscalls"].values())
+    }
+
+
+def print_result(result):
+    print("\n{backend}, update_concurrency={update_concurrency}, "
+            "fetch_concurrency={fetch_concurrency}, run {run}".format(**result))
+    for name in [ "cold", "warm" ]:
+        s = result.get(name)
+        if s is None:
+            continue
+        phases = s["phases"]
+        print("  {:5} {:7.2f}s total | login {:.2f}s | update {:.2f}s ({:.1f} files/s) | "
+                "fetch {:.2f}s ({:.1f} files/s, {:.1f} MB/s) | checkout {:.2f}s ({:.1f} files/s)"
+                .format(name, s["wall_time"], phases.get("login", 0), phases.get("update", 0),
+                s["update_files_per_s"], phases.get("fetch", 0), s["fetch_files_per_s"],
+                s["fetch_mb_per_s"], phases.get("checkout", 0), s["checkout_files_per_s"]))
+        print("        latency " + ", ".join("{} {:.1f}/{:.1f}ms".format(kind, l["mean"] * 1e3,
+                l["p95"] * 1e3) for kind, l in sorted(s["latency"].items()))
+                + " (mean/p95)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--courses", type=int, default=10)
+    parser.add_argument("--files", type=int, default=20, help="files per course")
+    parser.add_argument("--folders", type=int, default=4, help="folders per course")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="file size in bytes")
+    parser.add_argument("--latency", type=float, default=0.0,
+            help="delay of every request in seconds")
+    parser.add_argument("--duplicates", action="store_true",
+            help="serve the same files in every course")
+    parser.add_argument("--backend", type=comma_list(str), default=[ "threads" ],
+            help="comma-separated list of backends to compare")
+    parser.add_argument("--update-concurrency", type=comma_list(int), default=[ 4 ])
+    parser.add_argument("--fetch-concurrency", type=comma_list(int), default=[ 4 ])
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--warm", action="store_true",
+            help="also measure a second sync without any changes")
+    parser.add_argument("--json", metavar="FILE", help="write all results to FILE")
+    args = parser.parse_args()
+
+    mock = MockStudip(args.courses, args.files, args.folders, args.size, args.latency,
+            args.duplicates)
+    print("Mock server with {} courses, {} files of about {} bytes, {:.0f} ms latency".format(
+            len(mock.courses), mock.n_files, args.size, args.latency * 1e3))
+
+    results = []
+    failed = False
+    with mock:
+        for backend, update_concurrency, fetch_concurrency, run in itertools.product(
+                args.backend, args.update_concurrency, args.fetch_concurrency,
+                range(args.repeat)):
+            result = { "backend": backend, "update_concurrency": update_concurrency,
+                    "fetch_concurrency": fetch_concurrency, "run": run + 1 }
+            work_dir = tempfile.mkdtemp(prefix="studip-bench-")
+            try:
+                env = prepare_sync_dir(work_dir, mock, backend, update_concurrency,
+                        fetch_concurrency)
+                for name in [ "cold", "warm" ] if args.warm else [ "cold" ]:
+                    trace = run_client(work_dir, env, mock, name)
+                    if trace is None:
+                        failed = True
+                        break
+                    result[name] = summarize(trace, mock)
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            results.append(result)
+            print_result(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({ "courses": args.courses, "files": args.files, "folders": args.folders,
+                    "size": args.size, "latency": args.latency, "duplicates": args.duplicates,
+                    "results": results }, file, indent=1)
+            file.write("\n")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
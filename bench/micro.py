@@ -0,0 +1,120 @@
+"""Micro-benchmarks of the database listings and view operations on synthetic caches.
+
+For each scale, a sync directory is generated with bench.synthetic and the following steps are
+timed in order: the file listings, constructing the default view before anything is checked out,
+checking out all files, constructing the view again from its checkout index, gc with every blob
+linked, removing the view and gc removing every blob. The report shows the time of each step per
+scale and the exponent of its growth between the smallest and largest scale, where 1 means
+linear. Run from the repository root, e.g.
+
+    python3 -m bench.micro --scales 1000,10000,100000
+"""
+
+import argparse, contextlib, io, json, math, shutil, tempfile, time
+
+from os import path
+
+from studip.application import Application
+from studip.fs import StatCache
+from studip.views import ViewSynchronizer, FetchedFiles, checkout_views
+
+from .synthetic import generate
+
+
+def timed(results, name, function):
+    # Checkout and gc print a line per file, which is not what is measured here
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        value = function()
+        results[name] = time.perf_counter() - start
+    return value
+
+
+def view_synchronizer(sync_dir, db):
+    stats = StatCache()
+    view, = db.list_views(full=True)
+    return ViewSynchronizer(sync_dir, None, db, view, stats=stats,
+            fetched=FetchedFiles(sync_dir, db, stats))
+
+
+def gc(sync_dir, db):
+    app = Application()
+    app.sync_dir = sync_dir
+    app.database = db
+    app.stats = StatCache()
+    app.gc()
+
+
+def run_scale(n_files, files_per_course, files_per_folder, file_size):
+    """Generates a cache of n_files files and returns the time of each step."""
+    work_dir = tempfile.mkdtemp(prefix="studip-micro-")
+    sync_dir = path.join(work_dir, "sync")
+    try:
+        results = {}
+        db = timed(results, "generate", lambda: generate(sync_dir,
+                max(1, n_files // files_per_course), max(1, n_files // files_per_folder),
+                n_files, file_size))
+
+        timed(results, "list_files(full=True)", lambda: db.list_files(full=True))
+        timed(results, "iter_file_rows(id, remote_date)",
+                lambda: dict(db.iter_file_rows([ "id", "remote_date" ])))
+        timed(results, "list_file_blobs", db.list_file_blobs)
+        timed(results, "list_courses(full=True)", lambda: db.list_courses(full=True))
+
+        sync = timed(results, "view (unindexed)", lambda: view_synchronizer(sync_dir, db))
+        timed(results, "checkout", lambda: checkout_views([ sync ]))
+        timed(results, "list_checkouts", lambda: db.list_checkouts(0))
+        sync = timed(results, "view (indexed)", lambda: view_synchronizer(sync_dir, db))
+        timed(results, "gc (all linked)", lambda: gc(sync_dir, db))
+        timed(results, "remove", sync.remove)
+        timed(results, "gc (none linked)", lambda: gc(sync_dir, db))
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def growth(scales, times):
+    """Exponent k of time ~ n^k between the smallest and largest scale."""
+    (n0, t0), (n1, t1) = (scales[0], times[0]), (scales[-1], times[-1])
+    if n0 == n1 or t0 <= 0 or t1 <= 0:
+        return None
+    return math.log(t1 / t0) / math.log(n1 / n0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scales", default="1000,10000,100000",
+            help="comma-separated numbers of files")
+    parser.add_argument("--files-per-course", type=int, default=200)
+    parser.add_argument("--files-per-folder", type=int, default=10)
+    parser.add_argument("--size", type=int, default=1024 * 1024,
+            help="apparent size of each sparse file in bytes")
+    parser.add_argument("--json", metavar="FILE", help="write all results to FILE")
+    args = parser.parse_args()
+
+    scales = sorted(int(s) for s in args.scales.split(","))
+    results = []
+    for n_files in scales:
+        print("Measuring {} files...".format(n_files), flush=True)
+        results.append(run_scale(n_files, args.files_per_course, args.files_per_folder,
+                args.size))
+
+    fmt = "{:34}" + " {:>10}" * len(scales) + " {:>8}"
+    print()
+    print(fmt.format("step", *[ "{} files".format(n) for n in scales ] + [ "growth" ]))
+    for step in results[0]:
+        times = [ r[step] for r in results ]
+        k = growth(scales, times)
+        print(fmt.format(step, *[ "{:.3f}s".format(t) for t in times ]
+                + [ "n^{:.2f}".format(k) if k is not None else "-" ]))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump({ "scales": scales, "files_per_course": args.files_per_course,
+                    "files_per_folder": args.files_per_folder, "size": args.size,
+                    "results": results }, file, indent=1)
+            file.write("\n")
+
+
+if __name__ == "__main__":
+    main()
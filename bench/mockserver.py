@@ -0,0 +1,193 @@
+import hashlib, sys, threading, time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs, quote
+
+
+SESSION_COOKIE = "Seminar_Session=benchmark"
+
+
+class MockStudip:
+    """Emulates the parts of the Stud.IP web interface used by the client.
+
+    The server answers the Shibboleth login flow, the my_courses overview, course selection,
+    folder lists, file details and sendfile.php downloads, including Range requests. It has
+    n_courses courses with files_per_course files each, spread over folders_per_course folders.
+    File contents are generated from their ids, file_size bytes plus a few bytes per file so that
+    sizes differ. With duplicates set, all courses serve the same contents, which the client stores
+    only once. Every request is delayed by latency seconds.
+
+    Requests are counted by kind in the requests attribute."""
+
+    def __init__(self, n_courses=10, files_per_course=20, folders_per_course=4,
+            file_size=64 * 1024, latency=0.0, duplicates=False):
+        self.latency = latency
+        self.file_size = file_size
+        self.duplicates = duplicates
+        self.requests = {}
+        self.lock = threading.Lock()
+
+        self.courses = [ ("{:032x}".format(c + 1), "Benchmark Course {}".format(c))
+                for c in range(n_courses) ]
+        self.files = {}
+        for c, (course_id, _) in enumerate(self.courses):
+            self.files[course_id] = [ ("{:016x}{:016x}".format(c + 1, f + 1),
+                    "document{}.pdf".format(f), "Folder {}".format(f % max(folders_per_course, 1)),
+                    f) for f in range(files_per_course) ]
+        self.file_index = dict((f[0], f) for files in self.files.values() for f in files)
+
+        mock = self
+
+        class Handler(RequestHandler):
+            pass
+        Handler.mock = mock
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            # Many workers connect at once
+            request_queue_size = 128
+
+            def handle_error(self, request, client_address):
+                # Interrupted clients close their connections without reading the response
+                if not isinstance(sys.exc_info()[1], ConnectionError):
+                    super().handle_error(request, client_address)
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address
+        return "http://{}:{}".format(host, port)
+
+    @property
+    def n_files(self):
+        return len(self.file_index)
+
+    def content(self, file_id):
+        _, _, _, number = self.file_index[file_id]
+        seed = ("{:06}".format(number) if self.duplicates else file_id).encode("ascii")
+        size = self.file_size + 16 * number
+        return (seed * (size // len(seed) + 1))[:size]
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, status=200, headers={}):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.do_GET()
+
+    def do_GET(self):
+        mock = self.mock
+        if mock.latency:
+            time.sleep(mock.latency)
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        page = url.path
+
+        if page == "/studip/index.php":
+            mock.count("login")
+            return self.send('<form action="/idp/profile/SAML2/Redirect/SSO" method="post">'
+                    '</form>')
+        elif page == "/idp/profile/SAML2/Redirect/SSO":
+            mock.count("login")
+            return self.send('<form><input name="RelayState" value="relay">'
+                    '<input name="SAMLResponse" value="response"></form>')
+        elif page == "/Shibboleth.sso/SAML2/POST":
+            mock.count("login")
+            return self.send("", headers={ "Set-Cookie": SESSION_COOKIE + "; Path=/" })
+
+        if SESSION_COOKIE not in (self.headers.get("Cookie") or ""):
+            return self.send("Access denied", 403)
+
+        if page.endswith("/my_courses/set_semester"):
+            mock.count("overview")
+            return self.send(self.overview_page())
+        elif page == "/studip/seminar_main.php":
+            mock.count("course")
+            return self.send("")
+        elif page == "/studip/folder.php":
+            course_id = query["cid"][0]
+            if "open" in query:
+                mock.count("detail")
+                return self.send(self.details_page(course_id, mock.file_index[query["open"][0]]))
+            else:
+                mock.count("folder")
+                return self.send(self.folder_page(course_id))
+        elif page == "/studip/sendfile.php":
+            mock.count("sendfile")
+            return self.send_file(query["file_id"][0])
+        else:
+            return self.send("Not found", 404)
+
+    def overview_page(self):
+        rows = "".join('<tr><td>{0}</td><td></td><td>{0}</td>'
+                '<td><a href="seminar_main.php?auswahl={1}">{2} (Vorlesung)</a></td>'
+                '<td><a href="seminar_main.php?auswahl={1}&redirect_to=folder.php&cmd=all">'
+                '<img src="/icons/red/files.svg"></a></td></tr>'.format(i + 1, course_id, name)
+                for i, (course_id, name) in enumerate(self.mock.courses))
+        return ('<select name="sem_select"><optgroup><option value="ws">WS 16/17</option>'
+                '</optgroup></select><div id="my_seminars"><table><caption>WS 16/17</caption>'
+                '<thead><tr><th></th></tr></thead><tbody>' + rows + '</tbody></table></div>')
+
+    def folder_page(self, course_id):
+        return "".join('<div id="file_{0}_0"><a href="sendfile.php?type=0&file_id={0}'
+                '&file_name={1}"></a><table><tr><td><a href="dispatch.php/profile?username=a">'
+                'Author</a> 01.02.2017 - 13:45</td></tr></table></div>'.format(file_id,
+                quote(name)) for file_id, name, _, _ in self.mock.files[course_id])
+
+    def details_page(self, course_id, file):
+        file_id, name, folder, _ = file
+        return ('<div id="file_{0}_0"><span id="{0}_header" style="font-weight: bold">{1}</span>'
+                '<table><tr><td><a href="dispatch.php/profile?username=a">Author</a> '
+                '01.02.2017 - 13:45</td></tr></table>'
+                '<a href="folder.php?cid={2}">Allgemeiner Dateiordner / {3}</a>'
+                '<a href="sendfile.php?type=0&file_id={0}&file_name={4}"></a></div>'.format(
+                file_id, name, course_id, folder, quote(name)))
+
+    def send_file(self, file_id):
+        data = self.mock.content(file_id)
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        range = self.headers.get("Range")
+        if range and self.headers.get("If-Range", etag) == etag:
+            start = int(range.split("=")[1].rstrip("-"))
+            return self.send(data[start:], 206, { "ETag": etag,
+                    "Content-Range": "bytes {}-{}/{}".format(start, len(data) - 1, len(data)) })
+        return self.send(data, 200, { "ETag": etag })
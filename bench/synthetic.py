@@ -0,0 +1,97 @@
+"""Generates a synthetic sync directory with a large cache for benchmarks.
+
+The database is created through the client's Database class and thus from studip/sql/setup.sql,
+courses and files are added with the same methods the update uses. Every file is fetched into
+its own sparse blob in .studip/blobs, so that checkouts work without using up disk space. Run from
+the repository root, e.g.
+
+    python3 -m bench.synthetic /tmp/large --courses 500 --folders 10000 --files 100000
+"""
+
+import argparse, hashlib, os, time
+
+from datetime import datetime, timedelta
+from os import path
+
+from studip.database import Database, Semester, Course, File, Blob, SyncMode
+from studip.blobs import BlobStore
+
+
+def folder_paths(n_folders):
+    """Returns n_folders paths within a course, nested up to three levels below the general
+    folder."""
+    paths = [ ("Allgemeiner Dateiordner",) ]
+    for i in range(1, n_folders):
+        parent = paths[(i - 1) // 4]
+        paths.append(parent + ("Folder {}".format(i),) if len(parent) < 4
+                else paths[0] + ("Folder {}".format(i),))
+    return paths
+
+
+def generate(sync_dir, n_courses=500, n_folders=10000, n_files=100000, file_size=1024 * 1024,
+        n_semesters=4):
+    """Creates a sync directory with n_files files distributed evenly over n_courses courses and
+    n_folders folders. Returns the Database, which has all changes committed."""
+    dot_dir = path.join(sync_dir, ".studip")
+    os.makedirs(dot_dir, exist_ok=True)
+    db = Database(path.join(dot_dir, "cache.sqlite"))
+    store = BlobStore(sync_dir)
+    os.makedirs(store.blobs_dir, exist_ok=True)
+
+    semesters = [ Semester("{:032x}".format(s + 1), "WS {}/{}".format(10 + s, 11 + s), s)
+            for s in range(n_semesters) ]
+    db.update_semester_list(semesters)
+
+    folders_per_course = max(1, n_folders // n_courses)
+    paths = folder_paths(folders_per_course)
+    first_date = datetime(2016, 10, 1)
+
+    file_number = 0
+    for c in range(n_courses):
+        course = Course("{:032x}".format(c + 1), semester=semesters[c % n_semesters].name,
+                number=str(c + 1), name="Synthetic Course {}".format(c),
+                type=[ "Vorlesung", "Übung", "Seminar" ][c % 3], sync=SyncMode.Full)
+        db.add_course(course)
+
+        files = []
+        files_in_course = n_files // n_courses + (1 if c < n_files % n_courses else 0)
+        for f in range(files_in_course):
+            date = first_date + timedelta(minutes=file_number)
+            files.append(File("{:032x}".format(file_number + 1), course=course.id,
+                    path=paths[f % len(paths)], name="document{}".format(f), extension="pdf",
+                    author="Author {}".format(f % 20), description="Document {}.pdf".format(f),
+                    remote_date=date, local_date=date))
+            file_number += 1
+        db.store_files(files, [])
+
+        for file in files:
+            # Contents are all zeros, so the hash is made up from the file id
+            hash = hashlib.sha256(file.id.encode("ascii")).hexdigest()
+            with open(store.path(hash), "wb") as blob_file:
+                blob_file.truncate(file_size)
+            db.set_file_blob(file.id, 0, Blob(hash, file_size, hash))
+        db.commit()
+
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("sync_dir")
+    parser.add_argument("--courses", type=int, default=500)
+    parser.add_argument("--folders", type=int, default=10000)
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--size", type=int, default=1024 * 1024, help="file size in bytes")
+    args = parser.parse_args()
+
+    if path.exists(path.join(args.sync_dir, ".studip")):
+        parser.error("{} already contains a sync directory".format(args.sync_dir))
+
+    start = time.perf_counter()
+    generate(args.sync_dir, args.courses, args.folders, args.files, args.size)
+    print("Generated {} files in {} courses in {:.1f}s".format(args.files, args.courses,
+            time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -23,6 +23,9 @@ if __name__ == "__main__":
             "requests",
             "appdirs"
         ],
+        extras_require = {
+            "asyncio": [ "aiohttp" ]
+        },
         version = version,
         description = "CLI Client for the Stud.IP University Access Portal",
         long_description = long_descr,
@@ -0,0 +1,231 @@
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .session import SessionBase, SessionError, raise_fetch_error, parse_file_list_page, \
+        parse_file_details_page, check_folder_page, prepare_download, discard_partial_download, \
+        range_headers, partial_from_response, finish_download, request_kind, DOWNLOAD_CHUNK_SIZE
+from .blobs import BlobWriter, tail_range_headers
+
+
+# Seconds to wait for a connection and for each read. There is no limit on the duration of a whole
+# request, as with the threads backend, so that large downloads can take as long as they need.
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 120
+
+
+def trace_config(tracer):
+    """Returns an aiohttp TraceConfig that records each request with a Tracer."""
+    config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, context, params):
+        context.start = tracer.now()
+
+    async def on_request_end(session, context, params):
+        tracer.record_request(request_kind(str(params.url)), context.start,
+                tracer.now() - context.start, params.response.status)
+
+    async def on_response_chunk_received(session, context, params):
+        # Only sent for bodies read at once, streamed bodies are counted by whoever reads them
+        tracer.add_bytes(request_kind(str(params.url)), len(params.chunk))
+
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(on_request_end)
+    config.on_response_chunk_received.append(on_response_chunk_received)
+    return config
+
+
+class AsyncSession(SessionBase):
+    """Sends all requests as coroutines over a single aiohttp connection pool.
+
+    The session logs in and runs all coroutines on a private event loop, which its connection pool
+    is bound to. update_metadata() and fetch_files() block until their coroutines have finished,
+    so that the session can be used in place of the threaded Session."""
+
+    def __init__(self, config, db, user_name, password, sync_dir, tracer=None,
+            new_transport=None):
+        if aiohttp is None:
+            raise SessionError("The asyncio backend requires the aiohttp package")
+        if new_transport is not None:
+            # Transport adapters only exist for requests
+            raise SessionError("Recording and replaying requests requires the threads backend")
+
+        super().__init__(config, db, sync_dir, tracer)
+        self.loop = asyncio.new_event_loop()
+        self.http = None
+        try:
+            self.run(self.login(user_name, password))
+        except BaseException:
+            self.close()
+            raise
+
+
+    def run(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        try:
+            return self.loop.run_until_complete(task)
+        except BaseException:
+            # Give the coroutine a chance to clean up, e.g. after a KeyboardInterrupt
+            task.cancel()
+            try:
+                self.loop.run_until_complete(task)
+            except BaseException:
+                pass
+            raise
+
+
+    async def gather(self, coroutines):
+        """Like asyncio.gather(), but cancels all other coroutines as soon as one fails."""
+        tasks = [ asyncio.ensure_future(c) for c in coroutines ]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+
+    async def open(self):
+        # Each download may open a second connection to check for a duplicate blob
+        limit = max(int(self.config["connection", "update_concurrency"]),
+                2 * int(self.config["connection", "fetch_concurrency"]))
+        # unsafe allows cookies for servers addressed by IP
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit),
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT,
+                        sock_read=READ_TIMEOUT),
+                trace_configs=[ trace_config(self.tracer) ] if self.tracer is not None else None)
+
+
+    async def fetch_text(self, page, method, url, **kwargs):
+        try:
+            async with self.http.request(method, url, **kwargs) as r:
+                return await r.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise_fetch_error(page, e)
+
+
+    async def login(self, user_name, password):
+        await self.open()
+
+        html = await self.fetch_text("login page", "GET", self.login_url())
+        post_url = self.parse_login_page(html)
+
+        html = await self.fetch_text("login confirmation page", "POST", post_url,
+                data=self.login_credentials(user_name, password))
+        form_data = self.parse_login_response(html)
+
+        await self.fetch_text("login page", "POST", self.saml_url(), data=form_data)
+
+
+    async def update_metadata_async(self):
+        overview_page = await self.fetch_text("overview page", "POST", self.overview_url(),
+                data={ "sem_select": "current" })
+        self.update_course_list(overview_page)
+
+        semaphore = asyncio.Semaphore(int(self.config["connection", "update_concurrency"]))
+
+        async def fetch_details(task):
+            async with semaphore:
+                html = await self.fetch_text("file details", "GET", task["details_url"])
+            self.handle_file_details(task, parse_file_details_page(task["course"], html))
+
+        async def crawl_course(task):
+            async with semaphore:
+                try:
+                    async with self.http.get(task["course_url"]):
+                        pass
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    raise SessionError("Unable to set course: {}".format(str(e)))
+                try:
+                    async with self.http.get(task["folder_url"], headers=task["headers"]) as r:
+                        content = await r.read()
+                        validators = check_folder_page(task, r.status, r.headers, content)
+                        html = await r.text() if validators is not None else None
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    raise_fetch_error("file list", e)
+
+            file_list = parse_file_list_page(html) if html is not None else None
+            details_tasks = self.handle_file_list(task, file_list, validators)
+            await self.gather(fetch_details(t) for t in details_tasks)
+
+        await self.gather(crawl_course(t) for t in self.metadata_tasks())
+
+
+    async def fetch_files_async(self):
+        downloads = self.download_tasks()
+        if not downloads:
+            return
+
+        print()
+        semaphore = asyncio.Semaphore(int(self.config["connection", "fetch_concurrency"]))
+        self.partial_downloads = {}
+
+        async def fetch_tail(task, size):
+            async with self.http.get(task["url"], headers=tail_range_headers(size)) as r:
+                return await r.read() if r.status == 206 else None
+
+        async def open_download(task, offset):
+            r = await self.http.get(task["url"], headers=range_headers(task, offset))
+            if r.status == 416 and offset > 0:
+                # See DownloadPool.open_download()
+                r.release()
+                discard_partial_download(task)
+                offset = 0
+                r = await self.http.get(task["url"])
+            return r, offset
+
+        async def download(task):
+            file = task["file"]
+            part_path, offset, complete = prepare_download(task)
+
+            writer = None
+            if not complete:
+                async with semaphore:
+                    try:
+                        r, offset = await open_download(task, offset)
+                        async with r:
+                            r.raise_for_status()
+                            offset, partial = partial_from_response(file, offset, r.status,
+                                    r.headers)
+                            self.partial_downloads[file.id] = partial
+
+                            with BlobWriter(part_path, offset, partial.size,
+                                    task["blobs_by_size"]) as writer:
+                                async for chunk in r.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                                    writer.write(chunk)
+                                    if self.tracer is not None:
+                                        self.tracer.add_bytes("sendfile", len(chunk))
+                                    if writer.should_probe() and writer.probe(
+                                            await fetch_tail(task, partial.size)):
+                                        break
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        raise SessionError("Unable to download file {}: {}".format(file.name, e))
+
+            blob = finish_download(task, writer)
+            self.partial_downloads.pop(file.id, None)
+            self.handle_download(file, blob)
+
+        try:
+            await self.gather(download(t) for t in downloads)
+        finally:
+            self.store_partial_downloads(self.partial_downloads)
+
+
+    def update_metadata(self):
+        self.run(self.update_metadata_async())
+
+
+    def fetch_files(self):
+        self.run(self.fetch_files_async())
+
+
+    def close(self):
+        if self.http is not None:
+            self.loop.run_until_complete(self.http.close())
+            self.http = None
+        self.loop.close()
@@ -9,7 +9,11 @@ from .database import Database, View, QueryError, SyncMode
 from .util import prompt_choice, expand_int_range, encrypt_password, decrypt_password, Charset, \
         EscapeMode, ellipsize
 from .session import Session, SessionError, LoginError
-from .views import ViewSynchronizer
+from .views import ViewSynchronizer, FetchedFiles, checkout_views
+from .fs import StatCache
+from .blobs import BlobStore
+from .trace import Tracer, QueryProfiler
+from .cassette import Cassette, CassetteError, RecordingAdapter, ReplayAdapter
 
 
 class ApplicationExit(BaseException):
@@ -80,6 +84,7 @@ class Application:
 
         self.dot_dir = os.path.join(self.sync_dir, ".studip")
         self.create_path(self.dot_dir)
+        self.stats = StatCache()
 
         self.config_file_name = os.path.join(self.dot_dir, "studip.conf")
         self.db_file_name = os.path.join(self.dot_dir, "cache.sqlite")
@@ -89,7 +94,12 @@ class Application:
         self.config = Config(self.config_file_name, {
                 ("server", "studip_base"): "https://studip.uni-passau.de",
                 ("server", "sso_base"): "https://sso.uni-passau.de",
-                ("connection", "update_concurrency"): 4
+                ("connection", "update_concurrency"): 4,
+                ("connection", "fetch_concurrency"): 4,
+                ("connection", "backend"): "threads",
+                ("update", "mode"): "full",
+                ("update", "full_interval"): 24,
+                ("database", "journal_mode"): "delete"
             })
 
 
@@ -123,6 +133,18 @@ class Application:
         if ("user", "password") in self.config:
             password = decrypt_password(user_secret, self.config["user", "password"])
 
+        new_transport = self.open_cassette()
+
+        backend = self.config["connection", "backend"]
+        if backend == "asyncio":
+            # Only imported on demand, as it requires a more recent Python and aiohttp
+            from .aiosession import AsyncSession as session_class
+        elif backend == "threads":
+            session_class = Session
+        else:
+            sys.stderr.write("Unknown connection backend \"{}\"\n".format(backend))
+            raise ApplicationExit()
+
         while True:
             if user_name is None:
                 user_name = input("Stud.IP user name: ")
@@ -133,8 +155,8 @@ class Application:
                 login_changed = True
 
             try:
-                self.session = Session(self.config, self.database, user_name, password,
-                        self.sync_dir)
+                self.session = session_class(self.config, self.database, user_name, password,
+                        self.sync_dir, self.tracer if self.tracing else None, new_transport)
             except SessionError as e:
                 sys.stderr.write("\n{}\n".format(e))
                 if not isinstance(e, LoginError):
@@ -159,13 +181,63 @@ class Application:
                 self.config["user", "password"] = encrypt_password(user_secret, password)
 
 
+    def open_cassette(self):
+        """Returns a function creating transport adapters that record or replay requests, if
+        requested."""
+        if "record_file" in self.command_line:
+            try:
+                cassette = self.cassette = Cassette.record()
+            except Exception as e:
+                self.print_io_error("Unable to create", "temporary directory", e)
+                raise ApplicationExit()
+            return lambda: RecordingAdapter(cassette)
+        elif "replay_file" in self.command_line:
+            file_name = self.command_line["replay_file"]
+            try:
+                cassette = self.cassette = Cassette.load(file_name)
+            except CassetteError as e:
+                sys.stderr.write("Error: {}: {}\n".format(file_name, e))
+                raise ApplicationExit()
+            except Exception as e:
+                self.print_io_error("Unable to read", file_name, e)
+                raise ApplicationExit()
+            time_scale = self.command_line.get("time_scale", 1.0)
+            return lambda: ReplayAdapter(cassette, time_scale)
+        return None
+
+
+    def close_cassette(self):
+        """Saves the recorded requests, if recording, and releases the cassette's files."""
+        try:
+            if "record_file" in self.command_line:
+                file_name = self.command_line["record_file"]
+                try:
+                    self.cassette.save(file_name)
+                except Exception as e:
+                    self.print_io_error("Unable to write recorded requests to", file_name, e)
+        finally:
+            self.cassette.close()
+            self.cassette = None
+
+
     def open_database(self):
         try:
-            self.database = Database(self.db_file_name)
+            self.database = Database(self.db_file_name, self.profiler,
+                    wal=self.config["database", "journal_mode"].lower() == "wal")
         except Exception as e:
             self.print_io_error("Unable to open database", self.db_file_name, e)
             raise ApplicationExit()
 
+        if self.tracing:
+            self.database.trace_statements(self.tracer.count_statement)
+
+        store = BlobStore(self.sync_dir)
+        try:
+            store.adopt_legacy_files(self.database)
+        except OSError as e:
+            self.print_io_error("Unable to move fetched files to", store.blobs_dir, e)
+            raise ApplicationExit()
+
 
     def update_database(self):
         interrupt = None
@@ -180,34 +252,72 @@ class Application:
 
 
     def checkout(self):
-        for view in self.database.list_views(full=True):
-            sync = ViewSynchronizer(self.sync_dir, self.config, self.database, view)
-            sync.checkout()
+        with self.tracer.phase("scan"):
+            fetched = FetchedFiles(self.sync_dir, self.database, self.stats)
+            synchronizers = [ ViewSynchronizer(self.sync_dir, self.config, self.database, view,
+                    stats=self.stats, fetched=fetched)
+                    for view in self.database.list_views(full=True) ]
+        with self.tracer.phase("link"):
+            checkout_views(synchronizers)
+
+
+    def report_profile(self):
+        explain_query = self.database.explain_query if hasattr(self, "database") else None
+        print(self.profiler.report(explain_query))
+
+
+    def report_trace(self):
+        self.tracer.syscalls.update(self.stats.syscalls)
+        if "stats" in self.command_line:
+            print(self.tracer.summary())
+        if "trace_file" in self.command_line:
+            try:
+                self.tracer.write(self.command_line["trace_file"])
+            except Exception as e:
+                self.print_io_error("Unable to write trace to", self.command_line["trace_file"],
+                        e)
 
 
     def clear_cache(self):
-        try:
-            os.remove(self.db_file_name)
-        except Exception as e:
-            if not (isinstance(e, IOError) and e.errno == ENOENT):
-                self.print_io_error("Unable to remove database file", self.db_file_name, e)
-                raise ApplicationExit()
+        # Also remove the write-ahead log and its index, if the last run did not clean them up
+        for file_name in [ self.db_file_name, self.db_file_name + "-wal",
+                self.db_file_name + "-shm" ]:
+            try:
+                os.remove(file_name)
+            except Exception as e:
+                if not (isinstance(e, IOError) and e.errno == ENOENT):
+                    self.print_io_error("Unable to remove database file", file_name, e)
+                    raise ApplicationExit()
 
         print("Cache cleared.")
 
 
     def gc(self):
-        files_dir = os.path.join(self.dot_dir, "files")
+        # Blobs that are not linked into any view, leftovers from before the blob store and part
+        # files of downloads that will never be resumed, e.g. because their course is no longer
+        # synchronized
+        store = BlobStore(self.sync_dir)
+        resumable = set(os.path.basename(store.part_path(id, partial.version))
+                for id, partial in self.database.list_partial_downloads().items())
         removed_files = 0
-        for f in os.listdir(files_dir):
-            path = os.path.join(files_dir, f)
-            st = os.lstat(path)
-            if stat.S_ISREG(st.st_mode) and st.st_nlink < 2:
-                try:
-                    os.unlink(path)
-                    removed_files += 1
-                except IOError as e:
-                    self.print_io_error("Unable to remove cached file", path, e)
+        for files_dir in [ store.blobs_dir, store.legacy_dir ]:
+            try:
+                dirs, files = self.stats.listdir(files_dir)
+            except FileNotFoundError:
+                continue
+            for f in files:
+                path = os.path.join(files_dir, f)
+                if f in resumable:
+                    continue
+                st = self.stats.lstat(path)
+                if stat.S_ISREG(st.st_mode) and st.st_nlink < 2:
+                    try:
+                        os.unlink(path)
+                        self.stats.syscalls["unlink"] += 1
+                        self.stats.invalidate(path)
+                        removed_files += 1
+                    except IOError as e:
+                        self.print_io_error("Unable to remove cached file", path, e)
         print("Removed {} stale file(s)".format(removed_files))
 
 
@@ -220,7 +330,8 @@ class Application:
                 print("\n".join(v.name for v in views))
             else: # view_op == "reset-deleted"
                 for v in views:
-                    sync = ViewSynchronizer(self.sync_dir, self.config, self.database, v)
+                    sync = ViewSynchronizer(self.sync_dir, self.config, self.database, v,
+                            stats=self.stats)
                     sync.reset_deleted()
             return
 
@@ -297,11 +408,13 @@ class Application:
                         }[view.charset]
                     ))
             elif view_op == "rm":
-                view_sync = ViewSynchronizer(self.sync_dir, self.config, self.database, view)
+                view_sync = ViewSynchronizer(self.sync_dir, self.config, self.database, view,
+                        stats=self.stats)
                 view_sync.remove()
                 self.database.remove_view(view.id)
             else: # view_op == "reset-deleted"
-                view_sync = ViewSynchronizer(self.sync_dir, self.config, self.database, view)
+                view_sync = ViewSynchronizer(self.sync_dir, self.config, self.database, view,
+                        stats=self.stats)
                 view_sync.reset_deleted()
 
         self.database.commit()
@@ -388,6 +501,20 @@ class Application:
             "    help          Show this synopsis\n"
             "\nPossible global parameters:\n"
             "    -d <dir>      Sync directory, assuming most recent one if not given\n"
+            "    --stats       Print the time spent in each phase, request latencies and the\n"
+            "                  number of database statements and file system calls\n"
+            "    --trace <file>\n"
+            "                  Write the same data and every single request to a JSON file\n"
+            "    --profile-sql Print the time spent in each kind of database statement and the\n"
+            "                  query plans of the slowest ones\n"
+            "    --record <file>\n"
+            "                  Record all requests and responses to a cassette file\n"
+            "    --replay <file>\n"
+            "                  Answer all requests from a recorded cassette file instead of the\n"
+            "                  server\n"
+            "    --time-scale <factor>\n"
+            "                  Multiply the recorded request times by factor when replaying,\n"
+            "                  0 replays as fast as possible (default 1)\n"
             .format(sys.argv[0]))
 
 
@@ -409,6 +536,22 @@ class Application:
                 if args[i] == "-d" and i < len(args)-1:
                     self.command_line["sync_dir"] = args[i+1]
                     i += 1
+                elif args[i] == "--trace" and i < len(args)-1:
+                    self.command_line["trace_file"] = os.path.abspath(args[i+1])
+                    i += 1
+                elif args[i] == "--stats":
+                    self.command_line["stats"] = True
+                elif args[i] == "--profile-sql":
+                    self.command_line["profile_sql"] = True
+                elif args[i] in [ "--record", "--replay" ] and i < len(args)-1:
+                    self.command_line[args[i][2:] + "_file"] = os.path.abspath(args[i+1])
+                    i += 1
+                elif args[i] == "--time-scale" and i < len(args)-1:
+                    try:
+                        self.command_line["time_scale"] = float(args[i+1])
+                    except ValueError:
+                        return False
+                    i += 1
                 else:
                     return False
             else:
@@ -478,40 +621,66 @@ class Application:
             self.show_usage(sys.stderr)
             raise ApplicationExit()
 
+        # Phases are always timed, requests and statements are only traced on demand
+        self.tracer = Tracer()
+        self.tracing = "stats" in self.command_line or "trace_file" in self.command_line
+        self.profiler = QueryProfiler() if "profile_sql" in self.command_line else None
+        # Set by open_session() when recording or replaying requests
+        self.cassette = None
+
         self.setup_sync_dir()
+        try:
+            self.run_operation(self.command_line["operation"])
+        finally:
+            if self.cassette is not None:
+                self.close_cassette()
+            if self.profiler is not None:
+                self.report_profile()
+            if self.tracing:
+                self.report_trace()
+
 
-        op = self.command_line["operation"]
+    def run_operation(self, op):
+        phase = self.tracer.phase
 
-        if op in [ "update", "fetch", "checkout", "sync", "view", "course" ]:
+        if op in [ "update", "fetch", "checkout", "sync", "view", "course", "gc" ]:
             self.configure()
             with self.config:
-                self.open_database()
+                with phase("open-database"):
+                    self.open_database()
 
                 if op in [ "update", "fetch", "sync" ]:
-                    self.open_session()
+                    with phase("login"):
+                        self.open_session()
                     try:
-                        if op == "update":
-                            self.update_database()
-                        elif op == "fetch":
-                            self.fetch_files()
-                        elif op == "sync":
-                            self.update_database()
-                            self.fetch_files()
-                            self.checkout()
+                        if op in [ "update", "sync" ]:
+                            with phase("update"):
+                                self.update_database()
+                        if op in [ "fetch", "sync" ]:
+                            with phase("fetch"):
+                                self.fetch_files()
+                        if op == "sync":
+                            with phase("checkout"):
+                                self.checkout()
                     except SessionError as e:
                         sys.stderr.write("\n{}\n".format(e))
                         raise ApplicationExit()
+                    finally:
+                        self.session.close()
 
                 elif op == "checkout":
-                    self.checkout()
+                    with phase("checkout"):
+                        self.checkout()
                 elif op == "view":
-                    self.edit_views()
+                    with phase("view"):
+                        self.edit_views()
                 elif op == "course":
                     self.edit_courses()
+                elif op == "gc":
+                    with phase("gc"):
+                        self.gc()
         elif op == "clear-cache":
             self.clear_cache()
-        elif op == "gc":
-            self.gc()
         else: # op == "help"
             self.show_usage(sys.stdout)
 
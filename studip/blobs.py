@@ -0,0 +1,198 @@
+import os, hashlib
+
+from os import path
+
+from .database import Blob
+
+
+# Two downloads of the same size whose first and last PARTIAL_HASH_SIZE bytes match are assumed
+# to be identical
+PARTIAL_HASH_SIZE = 64 * 1024
+
+# Below this size, fetching the tail of a download to check for a duplicate does not pay off
+PROBE_MIN_SIZE = 1024 * 1024
+
+
+def partial_hash(head, tail):
+    sha = hashlib.sha256(head)
+    sha.update(tail)
+    return sha.hexdigest()
+
+
+def read_partial_hash(file_path, size):
+    with open(file_path, "rb") as file:
+        head = file.read(PARTIAL_HASH_SIZE)
+        file.seek(max(0, size - PARTIAL_HASH_SIZE))
+        tail = file.read(PARTIAL_HASH_SIZE)
+    return partial_hash(head, tail)
+
+
+def hash_file(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha
+
+
+def tail_range_headers(size):
+    return { "Range": "bytes={}-".format(size - PARTIAL_HASH_SIZE) }
+
+
+class BlobStore:
+    """Keeps the contents of fetched files in .studip/blobs, named by their SHA-256 hash.
+
+    Identical uploads in different courses share a single blob, which is also the target of all
+    hard links to them in the views. The database maps each (file, version) to its blob."""
+
+    def __init__(self, sync_dir):
+        self.sync_dir = sync_dir
+        self.blobs_dir = path.join(sync_dir, ".studip", "blobs")
+        self.legacy_dir = path.join(sync_dir, ".studip", "files")
+
+    def path(self, hash):
+        return path.join(self.blobs_dir, hash)
+
+    def part_path(self, file_id, version):
+        return path.join(self.blobs_dir, file_id
+                + ("." + str(version) if version > 0 else "") + ".part")
+
+    def describe(self, file_path, sha=None):
+        if sha is None:
+            sha = hash_file(file_path)
+        size = path.getsize(file_path)
+        return Blob(sha.hexdigest(), size, read_partial_hash(file_path, size))
+
+    def add(self, file_path, sha=None):
+        """Moves a complete file into the store and returns its Blob. If the store already
+        contains the same data, the file is removed instead."""
+        blob = self.describe(file_path, sha)
+        blob_path = self.path(blob.hash)
+        if path.isfile(blob_path):
+            os.unlink(file_path)
+        else:
+            os.replace(file_path, blob_path)
+        return blob
+
+    def adopt_legacy_files(self, db):
+        """Moves files fetched into .studip/files by earlier versions into the store.
+
+        Renaming keeps their inodes, so existing checkouts stay intact. Files whose contents are
+        already stored are removed once their links in the views have been replaced by links to
+        the stored blob."""
+        try:
+            names = set(os.listdir(self.legacy_dir))
+        except FileNotFoundError:
+            return
+        if not names:
+            self.remove_legacy_dir()
+            return
+
+        fetched = db.list_file_blobs()
+        legacy_files = [ (id, version, id + ("." + str(version) if version > 0 else ""))
+                for id, version in db.list_file_versions() if id not in fetched ]
+        legacy_files = [ (id, version, name) for id, version, name in legacy_files
+                if name in names ]
+        if not legacy_files:
+            return
+
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        print("Moving {} fetched file(s) into the blob store...".format(len(legacy_files)))
+        # Blob paths for the inodes of duplicates, by device and inode number
+        duplicate_inodes = {}
+        duplicates = []
+        try:
+            for id, version, name in legacy_files:
+                file_path = path.join(self.legacy_dir, name)
+                blob = self.describe(file_path)
+                blob_path = self.path(blob.hash)
+                if path.isfile(blob_path):
+                    st = os.lstat(file_path)
+                    duplicate_inodes[(st.st_dev, st.st_ino)] = blob_path
+                    duplicates.append((id, version, blob, file_path))
+                else:
+                    os.replace(file_path, blob_path)
+                    db.set_file_blob(id, version, blob)
+
+            # Only forget a duplicate once nothing links to it anymore, so that an interrupted
+            # run is completed next time
+            if duplicates:
+                view_dirs = [ path.normpath(path.join(self.sync_dir, view.base or ""))
+                        for view in db.list_views(full=True) ]
+                self.relink_views(view_dirs, duplicate_inodes)
+                for id, version, blob, file_path in duplicates:
+                    db.set_file_blob(id, version, blob)
+                    os.unlink(file_path)
+        finally:
+            db.commit()
+
+        self.remove_legacy_dir()
+
+    def remove_legacy_dir(self):
+        """Removes .studip/files if it is empty, so that it is not looked at again."""
+        try:
+            os.rmdir(self.legacy_dir)
+        except OSError:
+            pass
+
+    def relink_views(self, view_dirs, blob_paths):
+        """Replaces all hard links within the view directories to one of the inodes in blob_paths
+        by links to the corresponding blob."""
+        for view_dir in view_dirs:
+            for cwd, dirs, files in os.walk(view_dir):
+                dirs[:] = [ d for d in dirs if d != ".studip" ]
+                for f in files:
+                    file_path = path.join(cwd, f)
+                    st = os.lstat(file_path)
+                    blob_path = blob_paths.get((st.st_dev, st.st_ino))
+                    if blob_path is not None:
+                        temp_path = file_path + ".relink"
+                        os.link(blob_path, temp_path)
+                        os.replace(temp_path, file_path)
+
+
+class BlobWriter:
+    """Writes a download to its .part file while hashing it for the blob store.
+
+    If existing blobs have the same size as a new download, its first PARTIAL_HASH_SIZE bytes are
+    kept so that, together with the tail fetched separately, the download can be recognized as a
+    duplicate before it is complete."""
+
+    def __init__(self, part_path, offset, size, blobs_by_size):
+        self.file = open(part_path, "ab" if offset > 0 else "wb")
+        # Resumed downloads are hashed once complete
+        self.sha = hashlib.sha256() if offset == 0 else None
+        self.size = size
+
+        self.candidates = None
+        if offset == 0 and size is not None and size >= PROBE_MIN_SIZE:
+            self.candidates = blobs_by_size.get(size)
+        self.head = b""
+        self.duplicate = None
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        if self.sha is not None:
+            self.sha.update(chunk)
+        if self.candidates and len(self.head) < PARTIAL_HASH_SIZE:
+            self.head += chunk[:PARTIAL_HASH_SIZE - len(self.head)]
+
+    def should_probe(self):
+        return bool(self.candidates) and len(self.head) >= PARTIAL_HASH_SIZE
+
+    def probe(self, tail):
+        """Checks the download against existing blobs, given its last PARTIAL_HASH_SIZE bytes.
+        Returns the matching Blob, if any."""
+        candidates, self.candidates = self.candidates, None
+        if tail is not None:
+            self.duplicate = candidates.get(partial_hash(self.head, tail[-PARTIAL_HASH_SIZE:]))
+        return self.duplicate
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,234 @@
+import os, re, json, hashlib, shutil, tempfile, threading, time, zipfile
+
+from collections import deque
+from datetime import timedelta
+
+import requests
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+BODY_CHUNK_SIZE = 64 * 1024
+
+SAML_RESPONSE_INPUT = re.compile(rb"<input\b[^>]*\bname=[\"']SAMLResponse[\"'][^>]*>", re.I)
+INPUT_VALUE = re.compile(rb"(\bvalue=)([\"'])[^\"']*\2", re.I)
+
+
+class CassetteError(Exception):
+    pass
+
+
+def redact(body):
+    """Replaces the SAML assertion of the login confirmation page, which would let anyone holding
+    the cassette log in."""
+    return SAML_RESPONSE_INPUT.sub(lambda m: INPUT_VALUE.sub(rb"\1\2redacted\2", m.group(0)),
+            body)
+
+
+def request_key(method, url, headers):
+    # Downloads are resumed and probed with Range requests to the same URL
+    return (method, url, headers.get("Range"))
+
+
+class Cassette:
+    """The HTTP requests and responses of a run, for replaying it later without a server.
+
+    A cassette is a zip file with an index of all interactions in the order they were sent and
+    one compressed member per distinct response body, named by its SHA-256 hash. Request bodies
+    and headers are never stored, since they carry the login credentials and session cookies,
+    and neither are Set-Cookie response headers. The SAML assertion that the login confirmation
+    page passes on to Stud.IP is redacted. Requests that failed with a timeout or connection error
+    are stored with the name of the exception.
+
+    Only hashes are kept in memory. While recording, each body is written to a spool directory as
+    it arrives and only moved into the zip file by save(), while replaying, bodies are read from
+    the zip file on demand."""
+
+    version = 1
+
+    def __init__(self):
+        self.interactions = []
+        self.hashes = set()
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        # Interactions not yet replayed, by request_key()
+        self.queues = None
+        self.spool_dir = None
+        self.archive = None
+
+    @classmethod
+    def record(cls):
+        cassette = cls()
+        cassette.spool_dir = tempfile.mkdtemp(prefix="studip-cassette-")
+        return cassette
+
+    def spool_path(self, hash):
+        return os.path.join(self.spool_dir, hash)
+
+    def add_body(self, chunks):
+        """Stores a response body given as an iterable of byte strings and returns its hash."""
+        sha = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=self.spool_dir)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    file.write(chunk)
+            hash = sha.hexdigest()
+            with self.lock:
+                if hash not in self.hashes:
+                    os.rename(temp_path, self.spool_path(hash))
+                    self.hashes.add(hash)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+        return hash
+
+    def open_body(self, hash):
+        if self.archive is not None:
+            return self.archive.open("bodies/" + hash)
+        else:
+            return open(self.spool_path(hash), "rb")
+
+    def add(self, interaction):
+        with self.lock:
+            self.interactions.append(interaction)
+
+    def next_interaction(self, key):
+        """Returns the first interaction with the given request_key() that has not been replayed
+        yet, None if there is none."""
+        with self.lock:
+            if self.queues is None:
+                self.queues = {}
+                for interaction in self.interactions:
+                    self.queues.setdefault((interaction["method"], interaction["url"],
+                            interaction.get("range")), deque()).append(interaction)
+            queue = self.queues.get(key)
+            return queue.popleft() if queue else None
+
+    @classmethod
+    def load(cls, file_name):
+        cassette = cls()
+        try:
+            cassette.archive = zipfile.ZipFile(file_name, "r")
+            index = json.loads(cassette.archive.read("interactions.json").decode("utf-8"))
+            if index.get("version") != cls.version:
+                raise CassetteError("Unsupported cassette version {}".format(
+                        index.get("version")))
+            cassette.interactions = index["interactions"]
+            cassette.hashes = set(name[len("bodies/"):] for name in cassette.archive.namelist()
+                    if name.startswith("bodies/"))
+            for interaction in cassette.interactions:
+                if "body" in interaction and interaction["body"] not in cassette.hashes:
+                    raise CassetteError("Missing body {}".format(interaction["body"]))
+        except (zipfile.BadZipFile, KeyError, ValueError) as e:
+            cassette.close()
+            raise CassetteError("Invalid cassette: {}".format(e))
+        except BaseException:
+            cassette.close()
+            raise
+        return cassette
+
+    def save(self, file_name):
+        with self.lock, zipfile.ZipFile(file_name, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("interactions.json", json.dumps({ "version": self.version,
+                    "interactions": self.interactions }, indent=1))
+            for hash in self.hashes:
+                archive.write(self.spool_path(hash), "bodies/" + hash)
+
+    def close(self):
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+        if self.spool_dir is not None:
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+            self.spool_dir = None
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Sends requests to the server and records them in a Cassette.
+
+    Response bodies are read completely before they are returned. Bodies of streamed requests,
+    i.e. downloads, are spooled to disk and handed to the caller from there, other bodies are read
+    into memory as usual. Like the default adapter, each instance has its own connection pool, so
+    every requests session should get its own."""
+
+    def __init__(self, cassette):
+        super().__init__()
+        self.cassette = cassette
+        self.start = cassette.start
+
+    def send(self, request, stream=False, **kwargs):
+        interaction = { "method": request.method, "url": request.url,
+                "range": request.headers.get("Range"), "start": time.perf_counter() - self.start }
+        try:
+            r = super().send(request, stream=stream, **kwargs)
+            if stream:
+                hash = self.cassette.add_body(r.iter_content(BODY_CHUNK_SIZE))
+                r.raw.release_conn()
+                r.raw = self.cassette.open_body(hash)
+                r._content_consumed = False
+            else:
+                hash = self.cassette.add_body([ redact(r.content) ])
+        except requests.RequestException as e:
+            interaction["error"] = type(e).__name__
+            interaction["duration"] = time.perf_counter() - self.start - interaction["start"]
+            self.cassette.add(interaction)
+            raise
+
+        interaction.update({
+            "latency": r.elapsed.total_seconds(),
+            "duration": time.perf_counter() - self.start - interaction["start"],
+            "status": r.status_code,
+            "reason": r.reason,
+            "headers": [ [ key, value ] for key, value in r.headers.items()
+                    if key.lower() != "set-cookie" ],
+            "body": hash
+        })
+        self.cassette.add(interaction)
+        return r
+
+
+class ReplayAdapter(BaseAdapter):
+    """Answers requests from a Cassette instead of sending them.
+
+    Each request is answered by the next recorded interaction with the same method, URL and Range
+    header, which is shared between all adapters replaying the same cassette. Before answering,
+    the adapter waits for as long as the original request took, multiplied by time_scale, so 0
+    replays as fast as possible."""
+
+    def __init__(self, cassette, time_scale=1.0):
+        super().__init__()
+        self.cassette = cassette
+        self.time_scale = time_scale
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        interaction = self.cassette.next_interaction(request_key(request.method, request.url,
+                request.headers))
+        if interaction is None:
+            raise requests.ConnectionError("No recorded response for {} {}".format(
+                    request.method, request.url), request=request)
+
+        if self.time_scale > 0:
+            time.sleep(interaction["duration"] * self.time_scale)
+
+        if "error" in interaction:
+            error = getattr(requests.exceptions, interaction["error"], requests.ConnectionError)
+            raise error("Recorded {}".format(interaction["error"]), request=request)
+
+        r = requests.Response()
+        r.status_code = interaction["status"]
+        r.reason = interaction["reason"]
+        r.headers = CaseInsensitiveDict(interaction["headers"])
+        r.encoding = get_encoding_from_headers(r.headers)
+        r.raw = self.cassette.open_body(interaction["body"])
+        r.url = request.url
+        r.request = request
+        r.elapsed = timedelta(seconds=interaction["latency"] * self.time_scale)
+        r.connection = self
+        return r
+
+    def close(self):
+        pass
@@ -1,12 +1,23 @@
-import sqlite3, os, ast, shutil, re
+import sqlite3, os, shutil, re, time
 from enum import IntEnum
 
 from .util import EscapeMode, Charset, abbreviate_course_name, abbreviate_course_type
 
 SyncMode = IntEnum("SyncMode", "NoSync Metadata Full")
 
+# Separates the components of the materialized folder paths in the database
+PATH_SEPARATOR = "\x1f"
 
+
+def split_path(path):
+    return tuple(path.split(PATH_SEPARATOR)) if path else ()
+
+
+# The record types below use __slots__, a single update or checkout can create tens of thousands
+# of them
 class Semester:
+    __slots__ = ("id", "name", "order")
+
     def __init__(self, id, name=None, order=None):
         self.id = id
         self.name = name
@@ -17,14 +28,19 @@ class Semester:
 
 
 class Course:
+    __slots__ = ("id", "semester", "number", "name", "type", "sync", "activity", "_abbrev",
+            "_type_abbrev")
+
     def __init__(self, id, semester=None, number=None, name=None, abbrev=None, type=None,
-            type_abbrev=None, sync=None):
+            type_abbrev=None, sync=None, activity=None):
         self.id = id
         self.semester = semester
         self.number = number
         self.name = name
         self.type = type
         self.sync = sync
+        # Whether the overview page shows new files for this course, None if unknown
+        self.activity = activity
         self._abbrev = abbrev
         self._type_abbrev = type_abbrev
 
@@ -57,6 +73,10 @@ class Course:
 
 
 class File:
+    __slots__ = ("id", "course", "course_semester", "course_name", "_course_abbrev", "course_type",
+            "_course_type_abbrev", "path", "name", "extension", "author", "description",
+            "remote_date", "copyrighted", "local_date", "version")
+
     def __init__(self, id, course=None, course_semester=None, course_name=None, course_abbrev=None,
             course_type=None, course_type_abbrev=None, path=None, name=None, extension=None,
             author=None, description=None, remote_date=None, copyrighted=False, local_date=None,
@@ -80,7 +100,8 @@ class File:
 
     @property
     def course_abbrev(self):
-        return self._course_abbrev if self._course_abbrev else abbreviate_course_name(self.name)
+        return self._course_abbrev if self._course_abbrev \
+                else abbreviate_course_name(self.course_name)
 
     @property
     def course_type_abbrev(self):
@@ -92,6 +113,8 @@ class File:
 
 
 class Folder:
+    __slots__ = ("id", "name", "parent", "course")
+
     def __init__(self, id, name=None, parent=None, course=None):
         self.id = id
         self.name = name
@@ -102,6 +125,63 @@ class Folder:
         return self.id and self.name and (self.parent or self.course)
 
 
+class PartialDownload:
+    __slots__ = ("version", "size", "etag", "last_modified")
+
+    def __init__(self, version, size=None, etag=None, last_modified=None):
+        self.version = version
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def validator(self):
+        # Weak ETags must not be used in If-Range
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+
+class Blob:
+    __slots__ = ("hash", "size", "partial_hash")
+
+    def __init__(self, hash, size, partial_hash):
+        self.hash = hash
+        self.size = size
+        # Hash of the first and last PARTIAL_HASH_SIZE bytes, see blobs.py
+        self.partial_hash = partial_hash
+
+
+class FolderValidators:
+    __slots__ = ("etag", "last_modified", "hash")
+
+    def __init__(self, etag=None, last_modified=None, hash=None):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.hash = hash
+
+    def conditional_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class Checkout:
+    __slots__ = ("file", "path", "device", "inode", "mtime")
+
+    def __init__(self, file, path=None, device=None, inode=None, mtime=None):
+        self.file = file
+        self.path = path
+        self.device = device
+        self.inode = inode
+        self.mtime = mtime
+
+    def indexed(self):
+        return self.path is not None
+
+
 class View:
     def __init__(self, id, name=None, format="{course}/{type}/{short-path}/{name}{ext}",
             base=None, escape=EscapeMode.Similar, charset=Charset.Unicode):
@@ -124,18 +204,54 @@ class QueryError(Exception):
 
 
 class Database:
-    schema_version = 12
+    """The client's cache of Stud.IP metadata, fetched files and view state.
+
+    By default, the database uses SQLite's rollback journal, which also works in sync directories on
+    network file systems. With wal set, it runs in WAL mode with synchronous=NORMAL and memory-maps
+    the database file instead, which requires shared memory between processes and is only safe on
+    a local disk. In both modes, a committed transaction survives a crash of the client. In WAL
+    mode, the most recent commits may also be rolled back if the operating system crashes or loses
+    power, leaving an older but consistent database. group_commit() additionally delays commits to
+    bundle many small changes, so a crash can lose up to commit_group_size changes or
+    commit_group_interval seconds of them; all of these are fetched or checked out again on the
+    next run."""
+
+    schema_version = 19
+
+    # Limits on how many changes or how much time group_commit() bundles into one transaction
+    commit_group_size = 100
+    commit_group_interval = 5.0
+
+    def __init__(self, file_name, profiler=None, wal=False):
+        # A QueryProfiler that records all statements, if set
+        self.profiler = profiler
 
-    def __init__(self, file_name):
         def connect(self):
-            self.conn = sqlite3.connect(file_name, detect_types=sqlite3.PARSE_DECLTYPES)
+            # Queries are issued with a few dozen distinct SQL strings, which are parsed only
+            # once each with a large enough statement cache
+            self.conn = sqlite3.connect(file_name, detect_types=sqlite3.PARSE_DECLTYPES,
+                    cached_statements=256)
+            # The journal mode is stored in the database file, so it is always set explicitly to
+            # switch back from WAL
+            try:
+                self.query("PRAGMA journal_mode = {}".format("WAL" if wal else "DELETE"),
+                        expected_rows=1)
+            except sqlite3.DatabaseError:
+                pass # Keep the current journal, e.g. without shared memory support
+            if wal:
+                self.query("PRAGMA synchronous = NORMAL", expected_rows=0)
+                self.query("PRAGMA mmap_size = {}".format(64 * 1024 * 1024), expected_rows=0)
+            self.query("PRAGMA cache_size = -{}".format(16 * 1024), expected_rows=0) # KiB
+
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
 
         # Try using the existing db, if the version differs from the internal schema version,
         # delete the database and start over
         connect(self)
         db_version, = self.query("PRAGMA user_version", expected_rows=1)[0]
         if db_version < self.schema_version:
-            if db_version in [ 9, 11 ]:
+            if db_version in [ 9, 11, 12, 13, 14, 15, 16, 17, 18 ]:
                 # Disconnect and reconnect to create a backup
                 self.conn.close()
                 base_name, ext = os.path.splitext(file_name)
@@ -147,6 +263,20 @@ class Database:
                     self.query_script_file("migrate-9-11.sql")
                 if db_version < 12:
                     self.query_script_file("migrate-11-12.sql")
+                if db_version < 13:
+                    self.query_script_file("migrate-12-13.sql")
+                if db_version < 14:
+                    self.query_script_file("migrate-13-14.sql")
+                if db_version < 15:
+                    self.query_script_file("migrate-14-15.sql")
+                if db_version < 16:
+                    self.query_script_file("migrate-15-16.sql")
+                if db_version < 17:
+                    self.query_script_file("migrate-16-17.sql")
+                if db_version < 18:
+                    self.query_script_file("migrate-17-18.sql")
+                if db_version < 19:
+                    self.query_script_file("migrate-18-19.sql")
 
                 print("Migrated database from version {} to {}, backup saved to {}".format(
                         db_version, self.schema_version, backup_file))
@@ -169,26 +299,69 @@ class Database:
             raise DatabaseVersionError()
 
     def query(self, sql, expected_rows=-1, *args, **kwargs):
-        cursor = self.conn.cursor()
         if args:
             if not kwargs:
-                cursor.execute(sql, tuple(*args))
+                params = tuple(*args)
             else:
                 raise ValueError("Pass either positional or keyword arguments")
-        elif kwargs:
-            cursor.execute(sql, dict(**kwargs))
         else:
-            cursor.execute(sql)
+            params = dict(**kwargs)
 
+        start = time.perf_counter()
+        cursor = self.conn.cursor()
+        cursor.execute(sql, params)
+
+        rows = None
         if expected_rows != 0:
             rows = cursor.fetchmany(expected_rows)
+        if self.profiler is not None:
+            self.profiler.record(sql, time.perf_counter() - start,
+                    len(rows) if rows is not None else cursor.rowcount, params)
+
+        if rows is not None:
             if len(rows) < expected_rows:
                 raise QueryError("Expected at least {} rows, got {}".format(
                         expected_rows, len(rows)))
             return rows
 
+    def query_rows(self, sql, params):
+        """Like query(), but yields the rows while the caller iterates over them. The profiler
+        only records the time spent fetching them."""
+        start = time.perf_counter()
+        cursor = self.conn.cursor()
+        cursor.execute(sql, params)
+        elapsed = time.perf_counter() - start
+
+        count = 0
+        try:
+            while True:
+                start = time.perf_counter()
+                rows = cursor.fetchmany(256)
+                elapsed += time.perf_counter() - start
+                if not rows:
+                    break
+                count += len(rows)
+                yield from rows
+        finally:
+            if self.profiler is not None:
+                self.profiler.record(sql, elapsed, count, params)
+
+    def explain_query(self, sql, params):
+        """Returns the rows of EXPLAIN QUERY PLAN for a statement, without profiling it."""
+        return self.conn.execute("EXPLAIN QUERY PLAN " + sql, params or ()).fetchall()
+
+    def trace_statements(self, callback):
+        """Calls callback with the SQL of every statement executed from now on, including those
+        of executemany() once per row."""
+        self.conn.set_trace_callback(callback)
+
+
     def query_script(self, sql):
-        return self.conn.cursor().executescript(sql)
+        start = time.perf_counter()
+        cursor = self.conn.cursor().executescript(sql)
+        if self.profiler is not None:
+            self.profiler.record(sql, time.perf_counter() - start, 0, script=True)
+        return cursor
 
 
     def query_script_file(self, name):
@@ -199,14 +372,24 @@ class Database:
 
 
     def query_multiple(self, sql, args):
-        self.conn.cursor().executemany(sql, args)
+        if self.profiler is None:
+            self.conn.cursor().executemany(sql, args)
+            return
+
+        # Keep the parameters for explaining the statement later
+        args = list(args)
+        start = time.perf_counter()
+        cursor = self.conn.cursor()
+        cursor.executemany(sql, args)
+        self.profiler.record(sql, time.perf_counter() - start, cursor.rowcount,
+                args[0] if args else None)
 
 
     def update_semester_list(self, semesters):
         self.query_multiple("""
                 INSERT OR REPLACE INTO semesters (id, name, ord)
                 VALUES (:id, :name, :order)
-            """, (s.__dict__ for s in semesters))
+            """, (dict(id=s.id, name=s.name, order=s.order) for s in semesters))
 
 
     def list_courses(self, full=False, select_sync_yes=True, select_sync_metadata_only=True,
@@ -274,86 +457,206 @@ class Database:
             """, id=course.id, expected_rows=0)
 
 
-    def list_files(self, full=False, select_sync_yes=True, select_sync_metadata_only=True,
-            select_sync_no=True):
-        Mode = SyncMode
+    def list_folder_validators(self):
+        rows = self.query("""
+                SELECT id, folder_etag, folder_last_modified, folder_hash
+                FROM courses
+                WHERE folder_hash IS NOT NULL
+            """)
+        return dict((c, FolderValidators(e, l, h)) for c, e, l, h in rows)
+
+
+    def set_folder_validators(self, course_id, validators):
+        self.query("""
+                UPDATE courses
+                SET folder_etag = :etag, folder_last_modified = :lm, folder_hash = :hash
+                WHERE id = :id
+            """, id=course_id, etag=validators.etag, lm=validators.last_modified,
+                hash=validators.hash, expected_rows=0)
+
+
+    def list_course_sync_times(self):
+        rows = self.query("""
+                SELECT id, last_sync
+                FROM courses
+                WHERE last_sync IS NOT NULL
+            """)
+        return dict(rows)
+
+
+    def set_course_sync_time(self, course_id, last_sync):
+        self.query("""
+                UPDATE courses
+                SET last_sync = :last
+                WHERE id = :id
+            """, id=course_id, last=last_sync, expected_rows=0)
+
+
+    # Attributes of File and the file_details columns they are loaded from
+    file_columns = [ ("id", "id"), ("course", "course_id"), ("course_semester", "course_semester"),
+            ("course_name", "course_name"), ("course_abbrev", "course_abbrev"),
+            ("course_type", "course_type"), ("course_type_abbrev", "course_type_abbrev"),
+            ("path", "path"), ("name", "name"), ("extension", "extension"),
+            ("author", "author"), ("description", "description"),
+            ("remote_date", "remote_date"), ("copyrighted", "copyrighted"),
+            ("local_date", "local_date"), ("version", "version") ]
+
+    def iter_file_rows(self, columns, courses=None, select_sync_yes=True,
+            select_sync_metadata_only=True, select_sync_no=True):
+        """Yields tuples of the given File attributes for all files matching the filters.
+
+        Rows are read from the database while iterating, so the caller should not modify the files
+        table before the iteration is complete. courses restricts the listing to a collection of
+        course ids."""
+        sql_columns = dict(self.file_columns)
+        try:
+            select = ", ".join(sql_columns[c] for c in columns)
+        except KeyError as e:
+            raise ValueError("Unknown file attribute {}".format(e))
+
         sync_modes = [ str(int(enum)) for enable, enum in [ (select_sync_yes, SyncMode.Full),
                 (select_sync_metadata_only, SyncMode.Metadata), (select_sync_no, SyncMode.NoSync) ]
                 if enable ]
+        conditions = [ "sync IN ({})".format(", ".join(sync_modes)) ]
+        args = {}
+        if courses is not None:
+            courses = list(courses)
+            conditions.append("course_id IN ({})".format(", ".join(":c{}".format(i)
+                    for i in range(len(courses)))))
+            args.update(("c{}".format(i), c) for i, c in enumerate(courses))
+
+        rows = self.query_rows("""
+                SELECT {}
+                FROM file_details
+                WHERE {};
+            """.format(select, " AND ".join(conditions)), args)
+
+        if "path" in columns:
+            path_index = list(columns).index("path")
+            for row in rows:
+                row = list(row)
+                row[path_index] = split_path(row[path_index])
+                yield tuple(row)
+        else:
+            yield from rows
 
-        if full:
-            rows = self.query("""
-                    SELECT id, course_id, course_semester, course_name, course_abbrev, course_type,
-                        course_type_abbrev, path, name, extension, author, description, remote_date,
-                        copyrighted, local_date, version
-                    FROM file_details
-                    WHERE sync IN ({});
-                """.format(", ".join(sync_modes)))
-            # Path is encoded as the string representation of a python list
-            return [ File(i, j, s, c, b, o, u, ast.literal_eval(path), n, e, a, d, t, y, l, v)
-                    for i, j, s, c, b, o, u, path, n, e, a, d, t, y, l, v in rows ]
+    def iter_files(self, columns=None, **filters):
+        """Yields a File for each file matching the filters of iter_file_rows(). Only the given
+        attributes are loaded, all others are left at None."""
+        if columns is None:
+            columns = [ c for c, _ in self.file_columns ]
+        for row in self.iter_file_rows(columns, **filters):
+            yield File(**dict(zip(columns, row)))
 
+    def list_files(self, full=False, select_sync_yes=True, select_sync_metadata_only=True,
+            select_sync_no=True):
+        filters = dict(select_sync_yes=select_sync_yes,
+                select_sync_metadata_only=select_sync_metadata_only, select_sync_no=select_sync_no)
+        if full:
+            return list(self.iter_files(**filters))
         else:
-            rows = self.query("""
-                    SELECT id
-                    FROM file_details
-                    WHERE sync IN ({});
-                """.format(", ".join(sync_modes)))
-            return [id for (id,) in rows]
+            return [ id for id, in self.iter_file_rows([ "id" ], **filters) ]
+
+
+    def list_file_versions(self):
+        return self.query("""
+                SELECT id, version FROM files
+            """)
+
+
+    def list_blobs(self):
+        rows = self.query("""
+                SELECT hash, size, partial_hash FROM blobs
+            """)
+        return [ Blob(h, s, p) for h, s, p in rows ]
 
 
-    def create_parent_for_file(self, file):
+    def list_file_blobs(self):
+        """Returns the blob hash of the current version of each file that has been fetched."""
         rows = self.query("""
-                SELECT root FROM courses
-                WHERE id = :course
-            """, course=file.course)
-        parent, = rows[0]
-
-        for folder in file.path:
-            def query_subdirectory():
-                return self.query("""
-                        SELECT id FROM folders
-                        WHERE parent = :par AND name = :name
-                    """, par=parent, name=folder)
-
-            rows = query_subdirectory()
-            if not rows:
-                self.query("""
-                        INSERT INTO folders (name, parent)
-                        VALUES(:name, :par)
-                    """, name=folder, par=parent, expected_rows=0)
-                rows = query_subdirectory()
-            parent, = rows[0]
-
-        return parent
-
-
-    def add_file(self, file):
-        parent = self.create_parent_for_file(file)
+                SELECT b.file, b.blob
+                FROM file_blobs AS b
+                INNER JOIN files AS f ON b.file = f.id AND b.version = f.version
+            """)
+        return dict(rows)
+
+
+    def set_file_blob(self, file_id, version, blob):
         self.query("""
+                INSERT OR IGNORE INTO blobs (hash, size, partial_hash)
+                VALUES (:hash, :size, :partial)
+            """, hash=blob.hash, size=blob.size, partial=blob.partial_hash, expected_rows=0)
+        self.query("""
+                INSERT OR REPLACE INTO file_blobs (file, version, blob)
+                VALUES (:file, :version, :hash)
+            """, file=file_id, version=version, hash=blob.hash, expected_rows=0)
+
+
+    def create_folders(self, course_id, paths):
+        """Returns the folder ids for a set of paths within a course, creating missing folders.
+
+        All existing folders of the course are looked up at once by their materialized path."""
+        folders = dict(self.query("""
+                SELECT path, id FROM folders
+                WHERE course = :course
+            """, course=course_id))
+
+        # Executed directly for the id of each new folder
+        cursor = self.conn.cursor()
+        insert_sql = """
+                INSERT INTO folders (name, parent, course, path)
+                VALUES (:name, :par, :course, :path)
+            """
+
+        folder_ids = {}
+        for path in paths:
+            parent = folders[""]
+            key = ""
+            for name in path:
+                key = key + PATH_SEPARATOR + name if key else name
+                if key not in folders:
+                    params = dict(name=name, par=parent, course=course_id, path=key)
+                    start = time.perf_counter()
+                    cursor.execute(insert_sql, params)
+                    if self.profiler is not None:
+                        self.profiler.record(insert_sql, time.perf_counter() - start, 1, params)
+                    folders[key] = cursor.lastrowid
+                parent = folders[key]
+            folder_ids[tuple(path)] = parent
+
+        return folder_ids
+
+
+    def store_files(self, new_files, updated_files):
+        """Adds and updates the files of a course in bulk."""
+        files = new_files + updated_files
+        if not files:
+            return
+
+        course_id = files[0].course
+        folder_ids = self.create_folders(course_id, set(tuple(f.path) for f in files))
+
+        def file_row(file):
+            return dict(id=file.id, par=folder_ids[tuple(file.path)], name=file.name,
+                    ext=file.extension, auth=file.author, descr=file.description,
+                    creat=file.remote_date, copy=file.copyrighted, local=file.local_date)
+
+        self.query_multiple("""
                 INSERT INTO files (id, folder, name, extension, author, description, remote_date,
                     copyrighted, local_date, version)
                 VALUES (:id, :par, :name, :ext, :auth, :descr, :creat, :copy, :local, 0);
-            """, id=file.id, par=parent, name=file.name, ext=file.extension, auth=file.author,
-                descr=file.description, creat=file.remote_date, copy=file.copyrighted,
-                local=file.local_date, expected_rows=0)
-
-
-    def update_file(self, file):
-        parent = self.create_parent_for_file(file)
-        self.query("""
+            """, (file_row(f) for f in new_files))
+        self.query_multiple("""
                 UPDATE files
                 SET folder = :par, name = :name, extension = :ext, author = :auth,
                     description = :descr, remote_date = :creat, copyrighted = :copy,
                     local_date = :local, version = version + 1
                 WHERE id = :id;
-            """, id=file.id, par=parent, name=file.name, ext=file.extension, auth=file.author,
-                descr=file.description, creat=file.remote_date, copy=file.copyrighted,
-                local=file.local_date, expected_rows=0)
-        self.query("""
+            """, (file_row(f) for f in updated_files))
+        self.query_multiple("""
                 DELETE FROM checkouts
                 WHERE file=:id
-            """, id=file.id, expected_rows=0)
+            """, (dict(id=f.id) for f in updated_files))
 
 
     def update_file_local_date(self, file):
@@ -364,6 +667,29 @@ class Database:
             """, id=file.id, local=file.local_date, expected_rows=0)
 
 
+    def list_partial_downloads(self):
+        rows = self.query("""
+                SELECT file, version, size, etag, last_modified
+                FROM partial_downloads
+            """)
+        return dict((f, PartialDownload(v, s, e, l)) for f, v, s, e, l in rows)
+
+
+    def set_partial_download(self, file_id, partial):
+        self.query("""
+                INSERT OR REPLACE INTO partial_downloads (file, version, size, etag, last_modified)
+                VALUES (:file, :version, :size, :etag, :lm)
+            """, file=file_id, version=partial.version, size=partial.size, etag=partial.etag,
+                lm=partial.last_modified, expected_rows=0)
+
+
+    def remove_partial_download(self, file_id):
+        self.query("""
+                DELETE FROM partial_downloads
+                WHERE file = :file
+            """, file=file_id, expected_rows=0)
+
+
     def list_views(self, full=False):
         if full:
             rows = self.query("""
@@ -406,23 +732,52 @@ class Database:
 
     def list_checkouts(self, view_id):
         rows = self.query("""
-                SELECT file FROM checkouts
+                SELECT file, path, device, inode, mtime FROM checkouts
                 WHERE view=:view
             """, view=view_id)
-        return [ id for id, in rows ]
+        return dict((f, Checkout(f, p, d, i, m)) for f, p, d, i, m in rows)
 
-    def add_checkout(self, view_id, file_id):
-        self.query("""
-                INSERT INTO checkouts (view, file)
-                VALUES (:view, :file)
-            """, view=view_id, file=file_id, expected_rows=0)
+    def set_checkouts(self, view_id, checkouts):
+        self.query_multiple("""
+                INSERT OR REPLACE INTO checkouts (view, file, path, device, inode, mtime)
+                VALUES (:view, :file, :path, :dev, :ino, :mtime)
+            """, (dict(view=view_id, file=c.file, path=c.path, dev=c.device, ino=c.inode,
+                    mtime=c.mtime) for c in checkouts))
 
     def reset_checkouts(self, view_id):
         self.query("""
                 DELETE FROM checkouts
                 WHERE view=:view
             """, view=view_id, expected_rows=0)
+        self.set_view_directories(view_id, {})
+
+    def list_view_directories(self, view_id):
+        rows = self.query("""
+                SELECT path, mtime FROM view_directories
+                WHERE view=:view
+            """, view=view_id)
+        return dict(rows)
+
+    def set_view_directories(self, view_id, directories):
+        self.query("""
+                DELETE FROM view_directories
+                WHERE view=:view
+            """, view=view_id, expected_rows=0)
+        self.query_multiple("""
+                INSERT INTO view_directories (view, path, mtime)
+                VALUES (:view, :path, :mtime)
+            """, (dict(view=view_id, path=p, mtime=m) for p, m in directories.items()))
 
     def commit(self):
         self.conn.commit()
+        self.uncommitted = 0
+        self.last_commit = time.monotonic()
+
+    def group_commit(self):
+        """Marks the end of a change that does not need to be committed right away. The
+        transaction is committed once enough changes or time have accumulated."""
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_group_size \
+                or time.monotonic() - self.last_commit >= self.commit_group_interval:
+            self.commit()
 
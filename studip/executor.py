@@ -0,0 +1,165 @@
+from collections import deque, namedtuple
+from multiprocessing import cpu_count
+from threading import Thread, Condition, Lock
+from copy import deepcopy
+
+
+Completion = namedtuple("Completion", "task result")
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+class Executor:
+    """Runs tasks on a fixed set of worker threads.
+
+    Subclasses implement execute_task() and optionally init_thread() and cleanup_thread() to
+    manage per-thread state, which starts out as a copy of local_state.
+
+    At most max_pending tasks are queued or running at any time, submit() blocks until a slot
+    becomes available. Iterating over the executor yields a Completion(task, result) for every task
+    submitted so far, in completion order or, if ordered is set, in submission order. An exception
+    raised from execute_task() is re-raised by the iteration.
+
+    The executor must only be iterated from a single thread. execute_task() must not call submit(),
+    since all workers could end up waiting for a free slot.
+    """
+
+    def __init__(self, n_threads=cpu_count(), local_state={}, max_pending=None, ordered=False):
+        self.max_pending = max_pending if max_pending is not None else 4 * n_threads
+        self.ordered = ordered
+
+        self.queue = deque()
+        self.finished = {} if ordered else deque()
+        self.pending = 0
+        self.submitted = 0
+        self.consumed = 0
+        self.stopping = False
+
+        self.lock = Lock()
+        self.task_cv = Condition(self.lock)
+        self.slot_cv = Condition(self.lock)
+        self.result_cv = Condition(self.lock)
+
+        self.threads = [ Thread(target=self.thread_main, args=(deepcopy(local_state),), daemon=True)
+                for _ in range(n_threads) ]
+        for thread in self.threads:
+            thread.start()
+
+    def init_thread(self, local_state):
+        pass
+
+    def cleanup_thread(self, local_state):
+        pass
+
+    def execute_task(self, local_state, task):
+        pass
+
+    def thread_main(self, local_state):
+        self.init_thread(local_state)
+        try:
+            while True:
+                with self.lock:
+                    self.task_cv.wait_for(lambda: self.queue or self.stopping)
+                    if self.stopping:
+                        return
+                    no, task = self.queue.popleft()
+
+                try:
+                    result, error = self.execute_task(local_state, task), None
+                except Exception as e:
+                    result, error = None, e
+
+                with self.lock:
+                    if self.ordered:
+                        self.finished[no] = (task, result, error)
+                    else:
+                        self.finished.append((task, result, error))
+                    self.pending -= 1
+                    self.slot_cv.notify()
+                    self.result_cv.notify()
+        finally:
+            self.cleanup_thread(local_state)
+
+    def cancelled(self):
+        """Lets long-running tasks check whether they should give up early."""
+        return self.stopping
+
+    def has_free_slot(self):
+        with self.lock:
+            return self.pending < self.max_pending
+
+    def submit(self, task):
+        with self.lock:
+            self.slot_cv.wait_for(lambda: self.pending < self.max_pending or self.stopping)
+            if self.stopping:
+                raise TaskCancelled()
+            self.queue.append((self.submitted, task))
+            self.submitted += 1
+            self.pending += 1
+            self.task_cv.notify()
+
+    def next_completion(self):
+        """Waits for the next result. Returns None if all submitted tasks have been consumed."""
+        def ready():
+            if self.ordered:
+                return self.consumed in self.finished
+            else:
+                return len(self.finished) > 0
+
+        with self.lock:
+            self.result_cv.wait_for(lambda: self.consumed == self.submitted or ready())
+            if self.consumed == self.submitted:
+                return None
+            if self.ordered:
+                task, result, error = self.finished.pop(self.consumed)
+            else:
+                task, result, error = self.finished.popleft()
+            self.consumed += 1
+
+        if error is not None:
+            raise error
+        return Completion(task, result)
+
+    def __iter__(self):
+        while True:
+            completion = self.next_completion()
+            if completion is None:
+                return
+            yield completion
+
+    def map(self, tasks):
+        """Submits tasks from an iterable while yielding completions, keeping the executor busy
+        without ever blocking on a full queue."""
+        tasks = iter(tasks)
+        exhausted = False
+        while True:
+            while not exhausted and self.has_free_slot():
+                try:
+                    self.submit(next(tasks))
+                except StopIteration:
+                    exhausted = True
+
+            completion = self.next_completion()
+            if completion is None:
+                if exhausted:
+                    return
+            else:
+                yield completion
+
+    def shutdown(self):
+        """Discards all queued tasks and waits for running tasks to finish."""
+        with self.lock:
+            self.stopping = True
+            self.queue.clear()
+            self.task_cv.notify_all()
+            self.slot_cv.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
@@ -0,0 +1,101 @@
+import os, stat
+
+from os import path
+from collections import Counter
+
+
+class StatCache:
+    """Remembers lstat() results and directory listings for the duration of one command.
+
+    Directories are read with os.scandir(), and the stat results of their entries are only
+    requested when needed and then reused. Once a directory has been listed, lookups of names it
+    does not contain are answered without a system call. Callers that modify the file system must
+    invalidate() the paths they touch.
+
+    syscalls counts the system calls made through the cache. Callers add the ones they make
+    themselves, such as link or unlink, for the --stats summary."""
+
+    def __init__(self):
+        self.entries = {}
+        self.stats = {}
+        self.listings = {}
+        self.syscalls = Counter()
+
+    def lstat(self, file_path):
+        """Returns the stat result of a path without following symlinks, None if it does not
+        exist."""
+        try:
+            return self.stats[file_path]
+        except KeyError:
+            pass
+
+        entry = self.entries.get(file_path)
+        if entry is not None:
+            st = entry.stat(follow_symlinks=False)
+            self.syscalls["lstat"] += 1
+        elif file_path not in self.entries and path.dirname(file_path) in self.listings:
+            st = None
+        else:
+            self.syscalls["lstat"] += 1
+            try:
+                st = os.lstat(file_path)
+            except FileNotFoundError:
+                st = None
+        self.stats[file_path] = st
+        return st
+
+    def isfile(self, file_path):
+        st = self.lstat(file_path)
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def isdir(self, file_path):
+        st = self.lstat(file_path)
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def getmtime(self, file_path):
+        return self.lstat(file_path).st_mtime
+
+    def listdir(self, dir):
+        """Returns the names of all entries of a directory, split into directories and other
+        files."""
+        try:
+            return self.listings[dir]
+        except KeyError:
+            pass
+
+        dirs, files = [], []
+        self.syscalls["scandir"] += 1
+        for entry in os.scandir(dir):
+            entry_path = path.join(dir, entry.name)
+            self.entries[entry_path] = entry
+            self.stats.pop(entry_path, None)
+            (dirs if entry.is_dir(follow_symlinks=False) else files).append(entry.name)
+
+        self.listings[dir] = (dirs, files)
+        return dirs, files
+
+    def walk(self, top, prune=()):
+        """Like os.walk(top), but does not descend into the directories listed in prune."""
+        try:
+            dirs, files = self.listdir(top)
+        except OSError:
+            return
+
+        dirs = [ d for d in dirs if path.join(top, d) not in prune ]
+        yield top, dirs, files
+        for d in dirs:
+            yield from self.walk(path.join(top, d), prune)
+
+    def invalidate_stat(self, file_path):
+        """Forgets the stat result of a path whose metadata has changed."""
+        if file_path in self.entries:
+            # DirEntry caches its stat result, keep only the fact that the path exists
+            self.entries[file_path] = None
+        self.stats.pop(file_path, None)
+
+    def invalidate(self, file_path):
+        """Forgets everything about a path that has been created or removed."""
+        self.entries.pop(file_path, None)
+        self.stats.pop(file_path, None)
+        self.listings.pop(file_path, None)
+        self.listings.pop(path.dirname(file_path), None)
@@ -178,6 +178,8 @@ class CourseListParser(HTMLParser):
         elif self.state == State.before_tr and tag == "tr":
             self.state = State.tr
             self.current_url = self.current_number = self.current_name = ""
+            self.current_activity = None
+            self.in_files_a = False
         elif tag == "td" and self.state in [ State.tr, State.td_group, State.td_img, State.td_id,
                 State.td_name ]:
             self.state = State(int(self.state) + 1)
@@ -185,6 +187,18 @@ class CourseListParser(HTMLParser):
             attrs = dict(attrs)
             self.current_id = get_url_field(attrs["href"], "auswahl")
             self.state = State.a_name
+        elif self.state == State.after_td:
+            # The navigation icons following the course name link to the file folder, which is
+            # highlighted if it contains files added since the course was last visited
+            attrs = dict(attrs)
+            if tag == "a" and "href" in attrs and "folder.php" in attrs["href"]:
+                self.in_files_a = True
+                if self.current_activity is None:
+                    self.current_activity = False
+            elif tag == "img" and self.in_files_a:
+                icon = attrs.get("src", "") + " " + attrs.get("class", "")
+                if "/red/" in icon or "new" in icon or "attention" in icon:
+                    self.current_activity = True
 
     def handle_endtag(self, tag):
         State = CourseListParser.State
@@ -200,7 +214,9 @@ class CourseListParser(HTMLParser):
             if tag == "a":
                 self.state = State.td_name
         elif self.state == State.after_td:
-            if tag == "tr":
+            if tag == "a":
+                self.in_files_a = False
+            elif tag == "tr":
                 full_name = compact(self.current_name)
                 name, type = COURSE_NAME_TYPE_RE.match(full_name).groups()
                 match = DUPLICATE_TYPE_RE.match(name)
@@ -210,7 +226,8 @@ class CourseListParser(HTMLParser):
                 self.courses.append(Course(id=self.current_id,
                         semester=compact(self.current_semester),
                         number=compact(self.current_number),
-                        name=name, type=type, sync=SyncMode.NoSync))
+                        name=name, type=type, sync=SyncMode.NoSync,
+                        activity=self.current_activity))
                 self.state = State.before_tr
 
     def handle_data(self, data):
@@ -1,6 +1,8 @@
-import os, time, threading, ctypes
+import os, time, threading, ctypes, hashlib
 
-from requests import session, RequestException, Timeout
+from datetime import datetime, timedelta
+
+from requests import session, RequestException
 from urllib.parse import urlencode
 from os import path
 from threading import Thread, Condition, Lock
@@ -8,10 +10,15 @@ from copy import deepcopy
 from enum import IntEnum
 
 from .parsers import *
-from .database import SyncMode
+from .database import SyncMode, PartialDownload, FolderValidators
 from .util import prompt_choice, ellipsize, escape_file_name, \
         abbreviate_course_name, abbreviate_course_type
-from .async import ThreadPool
+from .executor import Executor, TaskCancelled
+from .fs import StatCache
+from .blobs import BlobStore, BlobWriter, tail_range_headers
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
 
 
 class SessionError(Exception):
@@ -25,12 +32,165 @@ def raise_fetch_error(page, e):
     raise SessionError("Unable to fetch {}: {}".format(page, str(e)))
 
 
-class SessionPool(ThreadPool):
-    def __init__(self, n_threads, cookies):
-        super().__init__(n_threads, { "cookies": cookies })
+def parse_file_list_page(html):
+    try:
+        return parse_file_list(html)
+    except ParserError:
+        raise SessionError("Unable to parse file list")
+
+
+def check_folder_page(task, status, headers, content):
+    """Returns the validators of a folder list response, or None if the page has not changed
+    since the validators stored with the task were recorded."""
+    stored = task["validators"]
+    if status == 304:
+        return None
+
+    validators = FolderValidators(headers.get("ETag"), headers.get("Last-Modified"),
+            hashlib.sha1(content).hexdigest())
+    if stored and stored.hash == validators.hash:
+        return None
+    return validators
+
+
+def parse_file_details_page(course, html):
+    try:
+        return parse_file_details(course.id, html)
+    except ParserError:
+        raise SessionError("Unable to parse file details")
+
+
+def prepare_download(task):
+    """Determines the .part file for a download and how much of it can be reused.
+
+    Returns the part file's path, the offset to resume from and whether the part file is already
+    complete."""
+    file = task["file"]
+    partial = task["partial"]
+
+    # Data is collected in a .part file and only moved into the blob store once complete, so
+    # that an interrupted download never shows up as a fetched file but can be resumed later
+    part_path = task["part_path"]
+    if partial and partial.version != file.version:
+        try:
+            os.unlink(task["store"].part_path(file.id, partial.version))
+        except OSError:
+            pass
+
+    offset = 0
+    if partial and partial.version == file.version and partial.validator():
+        try:
+            offset = path.getsize(part_path)
+        except OSError:
+            pass
+
+    complete = partial is not None and partial.size is not None and offset == partial.size > 0
+    return part_path, offset, complete
+
+
+def discard_partial_download(task):
+    """Starts a download over that cannot be resumed. The stored validators are replaced once the
+    new response arrives, and removed with the completed download."""
+    try:
+        os.unlink(task["part_path"])
+    except OSError:
+        pass
+    task["partial"] = None
+
+
+def range_headers(task, offset):
+    if offset > 0:
+        return { "Range": "bytes={}-".format(offset), "If-Range": task["partial"].validator() }
+    else:
+        return {}
+
+
+def partial_from_response(file, offset, status, headers):
+    """Returns the offset at which the response body starts and the validators to store for
+    resuming it."""
+    if status == 206:
+        size = parse_content_range_size(headers.get("Content-Range"))
+    else:
+        # The server ignored the Range header or the file has changed since the download was
+        # interrupted, so start over
+        offset = 0
+        size = headers.get("Content-Length")
+        size = int(size) if size is not None else None
+    return offset, PartialDownload(file.version, size, headers.get("ETag"),
+            headers.get("Last-Modified"))
+
+
+def finish_download(task, writer):
+    """Moves a completed download into the blob store and returns its Blob."""
+    file = task["file"]
+    part_path = task["part_path"]
+    file.local_date = file.remote_date
+
+    if writer is not None and writer.duplicate is not None:
+        os.unlink(part_path)
+        return writer.duplicate
+
+    timestamp = time.mktime(file.local_date.timetuple())
+    os.utime(part_path, (timestamp, timestamp))
+    return task["store"].add(part_path, writer.sha if writer is not None else None)
+
+
+def request_kind(url):
+    """Classifies a request by its URL for the --stats summary."""
+    if "sendfile.php" in url:
+        return "sendfile"
+    elif "folder.php" in url:
+        return "detail" if "&open=" in url else "folder"
+    elif "seminar_main.php" in url:
+        return "course"
+    elif "my_courses" in url:
+        return "overview"
+    else:
+        return "login"
+
+
+def trace_hook(tracer):
+    """Returns a requests response hook that records each request with a Tracer."""
+    def hook(r, *args, **kwargs):
+        kind = request_kind(r.url)
+        latency = r.elapsed.total_seconds()
+        tracer.record_request(kind, tracer.now() - latency, latency, r.status_code)
+        # Streamed bodies are counted by whoever reads them
+        if not kwargs.get("stream"):
+            tracer.add_bytes(kind, len(r.content))
+    return hook
+
+
+def http_session(tracer=None, new_transport=None):
+    """Creates a requests session. If new_transport is set, it is called to create the transport
+    adapter that all requests of the session are sent through, e.g. to record or replay them."""
+    http = requests.session()
+    if new_transport is not None:
+        transport = new_transport()
+        http.mount("http://", transport)
+        http.mount("https://", transport)
+    if tracer is not None:
+        http.hooks["response"].append(trace_hook(tracer))
+    return http
+
+
+def parse_content_range_size(content_range):
+    """Extracts the complete length from a header such as "bytes 100-199/200"."""
+    try:
+        size = content_range.rsplit("/", 1)[1]
+        return int(size) if size != "*" else None
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class SessionPool(Executor):
+    def __init__(self, n_threads, cookies, tracer=None, new_transport=None, **kwargs):
+        self.tracer = tracer
+        self.new_transport = new_transport
+        super().__init__(n_threads, { "cookies": cookies }, **kwargs)
 
     def init_thread(self, local_state):
-        session = requests.session()
+        session = http_session(self.tracer, self.new_transport)
         session.cookies = local_state["cookies"]
         local_state["session"] = session
 
@@ -38,13 +198,116 @@ class SessionPool(ThreadPool):
         local_state["session"].close()
 
     def execute_task(self, local_state, task):
-        return local_state["session"].request(task["method"], *task["args"], **task["kwargs"])
+        # Tasks are dicts that may carry additional keys identifying the request to the caller
+        return local_state["session"].request(task["method"], task["url"],
+                **task.get("kwargs", {}))
+
 
-    def defer_request(self, method, *args, **kwargs):
-        self.defer({ "method": method, "args": args, "kwargs": kwargs })
+class MetadataPool(SessionPool):
+    """Crawls folder lists and file details of several courses at once.
 
+    Every page of a course is requested with its cid parameter, which makes Stud.IP open that
+    course for the request regardless of which course was selected last in the shared session.
+    The seminar_main.php selection is still made first, as in the single-threaded crawler, and
+    the folder list is only requested once its response has arrived. It happens in the same task
+    as the folder list request, so it needs no ordering relative to other courses."""
+
+    def execute_task(self, local_state, task):
+        http = local_state["session"]
+        course = task["course"]
+
+        if task["type"] == "folder":
+            try:
+                http.get(task["course_url"]).close()
+            except RequestException as e:
+                raise SessionError("Unable to set course: {}".format(str(e)))
+
+            try:
+                r = http.get(task["folder_url"], headers=task["headers"])
+            except RequestException as e:
+                raise_fetch_error("file list", e)
+
+            validators = check_folder_page(task, r.status_code, r.headers, r.content)
+            if validators is None:
+                return None, None
+            return parse_file_list_page(r.text), validators
+
+        else: # task["type"] == "details"
+            try:
+                r = http.get(task["details_url"])
+            except RequestException as e:
+                raise_fetch_error("file details", e)
+
+            return parse_file_details_page(course, r.text)
+
+
+class DownloadPool(SessionPool):
+    def __init__(self, n_threads, cookies, **kwargs):
+        # Validators of all downloads that have started but not yet completed, by file id
+        self.partial_downloads = {}
+        super().__init__(n_threads, cookies, **kwargs)
+
+    def fetch_tail(self, http, task, size):
+        with http.get(task["url"], headers=tail_range_headers(size), stream=True) as r:
+            if r.status_code != 206:
+                return None
+            if self.tracer is not None:
+                self.tracer.add_bytes("sendfile", len(r.content))
+            return r.content
+
+    def open_download(self, http, task, offset):
+        """Requests a download from offset and returns the response and the offset."""
+        r = http.get(task["url"], headers=range_headers(task, offset), stream=True)
+        if r.status_code == 416 and offset > 0:
+            # The part file reaches or exceeds the end of the file, e.g. because it is complete
+            # but its size was unknown, so it cannot be resumed
+            r.close()
+            discard_partial_download(task)
+            offset = 0
+            r = http.get(task["url"], stream=True)
+        return r, offset
+
+    def execute_task(self, local_state, task):
+        file = task["file"]
+        http = local_state["session"]
+        part_path, offset, complete = prepare_download(task)
+
+        writer = None
+        if not complete:
+            try:
+                r, offset = self.open_download(http, task, offset)
+                with r:
+                    r.raise_for_status()
+                    offset, partial = partial_from_response(file, offset, r.status_code, r.headers)
+                    with self.lock:
+                        self.partial_downloads[file.id] = partial
+
+                    with BlobWriter(part_path, offset, partial.size,
+                            task["blobs_by_size"]) as writer:
+                        for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            if self.cancelled():
+                                raise TaskCancelled()
+                            writer.write(chunk)
+                            if self.tracer is not None:
+                                self.tracer.add_bytes("sendfile", len(chunk))
+                            if writer.should_probe() \
+                                    and writer.probe(self.fetch_tail(http, task, partial.size)):
+                                break
+            except RequestException as e:
+                raise SessionError("Unable to download file {}: {}".format(file.name, e))
+
+        blob = finish_download(task, writer)
+        with self.lock:
+            self.partial_downloads.pop(file.id, None)
+        return file, blob
+
+
+class SessionBase:
+    """Steps of a synchronization that do not depend on how requests are sent.
+
+    Subclasses perform the actual HTTP requests and feed the pages they receive to these
+    methods, which are expected to be called from a single thread."""
 
-class Session:
     def sso_url(self, url):
         return self.config["server", "sso_base"] + url
 
@@ -52,57 +315,48 @@ class Session:
         return self.config["server", "studip_base"] + url
 
 
-    def __init__(self, config, db, user_name, password, sync_dir):
+    def __init__(self, config, db, sync_dir, tracer=None):
         self.db = db
         self.config = config
         self.sync_dir = sync_dir
+        # Records requests for --stats and --trace if set
+        self.tracer = tracer
 
-        self.http = requests.session()
 
-        try:
-            r = self.http.get(self.studip_url("/studip/index.php?again=yes&sso=shib"))
-        except RequestException as e:
-            raise_fetch_error("login page", e)
+    def login_url(self):
+        return self.studip_url("/studip/index.php?again=yes&sso=shib")
 
+    def login_credentials(self, user_name, password):
+        return {
+            "j_username": user_name,
+            "j_password": password,
+            "uApprove.consent-revocation": "",
+            "_eventId_proceed": ""
+        }
+
+    def parse_login_page(self, html):
         try:
-            form_data = parse_login_form(r.text)
+            return self.sso_url(parse_login_form(html).post_url)
         except ParserError:
             raise LoginError("Error parsing login page")
 
+    def parse_login_response(self, html):
         try:
-            r = self.http.post(
-                    self.sso_url(form_data.post_url),
-                    data = {
-                        "j_username": user_name,
-                        "j_password": password,
-                        "uApprove.consent-revocation": "",
-                        "_eventId_proceed": ""
-                    }
-                )
-        except RequestException as e:
-            raise_fetch_error("login confirmation page", e)
-
-        try:
-            form_data = parse_saml_form(r.text)
+            return parse_saml_form(html)
         except ParserError as e:
             message = "Login failed"
             if e.message:
                 message += ": " + e.message
             raise LoginError(message)
 
-        try:
-            r = self.http.post(self.studip_url("/Shibboleth.sso/SAML2/POST"), form_data)
-        except RequestException as e:
-            raise_fetch_error("login page", e)
+    def saml_url(self):
+        return self.studip_url("/Shibboleth.sso/SAML2/POST")
 
 
-    def update_metadata(self):
-        url = self.studip_url("/studip/dispatch.php/my_courses/set_semester")
-        try:
-            overview_page = self.http.post(url, data={ "sem_select": "current" }).text
-        except RequestException as e:
-            raise_fetch_error("overview page", e)
+    def overview_url(self):
+        return self.studip_url("/studip/dispatch.php/my_courses/set_semester")
 
+    def update_course_list(self, overview_page):
         try:
             semester_list = parse_semester_list(overview_page)
         except ParserError:
@@ -143,113 +397,247 @@ class Session:
                 course.sync = { "y" : SyncMode.Full, "n" : SyncMode.NoSync }[sync]
             self.db.add_course(course)
 
+        self.course_activity = dict((course.id, course.activity) for course in remote_courses)
+
+
+    def metadata_tasks(self):
+        """Returns one task for fetching the file list of each synchronized course."""
         sync_courses = self.db.list_courses(full=True, select_sync_no=False)
-        last_course_synced = False
-        db_files = self.db.list_files(full=True, select_sync_yes=True,
-                select_sync_metadata_only=True, select_sync_no=False)
-        db_file_dict = dict((f.id, f) for f in db_files)
+        self.files_to_fetch = 0
+        self.files_fetched = 0
+
+        # Validators of each course's folder list are only stored once all of the course's new
+        # files have been recorded, so that an interrupted update is repeated in full next time
+        folder_validators = self.db.list_folder_validators()
+        self.pending_courses = {}
+        self.update_time = datetime.now()
+
+        # In incremental mode, courses without new files on the overview page are skipped unless
+        # they have not been crawled within the full update interval
+        incremental = self.config["update", "mode"] == "incremental"
+        full_interval = timedelta(hours=float(self.config["update", "full_interval"]))
+        sync_times = self.db.list_course_sync_times()
+
+        tasks = []
+        for course in sync_courses:
+            if incremental and self.course_activity.get(course.id) is False \
+                    and course.id in sync_times \
+                    and self.update_time - sync_times[course.id] < full_interval:
+                print("No activity in {} {} ".format(course.type, course.name))
+                continue
+
+            validators = folder_validators.get(course.id)
+            tasks.append({ "type": "folder", "course": course,
+                "course_url": self.studip_url("/studip/seminar_main.php?auswahl=" + course.id),
+                "folder_url": self.studip_url("/studip/folder.php?cid=" + course.id + "&cmd=all"),
+                "validators": validators,
+                "headers": validators.conditional_headers() if validators else {} })
+
+        # Only the dates are needed to tell which files have been updated, and only for the
+        # courses that are crawled
+        crawled_courses = None
+        if len(tasks) < len(sync_courses):
+            crawled_courses = [ task["course"].id for task in tasks ]
+        self.db_file_dates = dict(self.db.iter_file_rows([ "id", "remote_date" ],
+                courses=crawled_courses, select_sync_no=False))
+        return tasks
+
+    def handle_file_list(self, task, file_list, validators):
+        """Returns one task for fetching the details of each new or updated file of a course.
+
+        file_list is None if the course's folder list has not changed since the last update."""
+        course = task["course"]
+        db_file_dates = self.db_file_dates
+
+        if file_list is None:
+            print("No changes for {} {} ".format(course.type, course.name))
+            self.db.set_course_sync_time(course.id, self.update_time)
+            return []
+
+        new_files = [ file_id for file_id, _ in file_list if file_id not in db_file_dates ]
+        updated_files = [ file_id for file_id, date in file_list
+                if file_id in db_file_dates and db_file_dates[file_id] != date ]
+
+        new_files_str = str(len(new_files)) if new_files else "No"
+        updated_files_str = ""
+        if len(updated_files) > 0:
+            updated_files_str = ", {} updated ".format(len(updated_files))
+
+        print("{} new{} file(s) for {} {} ".format(new_files_str, updated_files_str,
+                course.type, course.name))
+
+        files_to_fetch = new_files + updated_files
+        self.files_to_fetch += len(files_to_fetch)
+        self.pending_courses[course.id] = { "remaining": len(files_to_fetch), "new": [],
+                "updated": [], "validators": validators }
+        if not files_to_fetch:
+            self.complete_course(course)
+
+        return [ { "type": "details", "course": course, "file_id": file_id,
+                "details_url": task["folder_url"] + "&open=" + file_id,
+                "new": file_id not in db_file_dates } for file_id in files_to_fetch ]
+
+    def handle_file_details(self, task, file):
+        course = task["course"]
+        self.files_fetched += 1
+        print("Fetched metadata for file {}/{}: ".format(self.files_fetched, self.files_to_fetch),
+                end="", flush=True)
+        pending = self.pending_courses[course.id]
+        if file.complete():
+            (pending["new"] if task["new"] else pending["updated"]).append(file)
+            print(" " + file.description)
+        else:
+            # Make sure the file is requested again on the next update
+            pending["validators"] = None
+            print(" <bad format>")
+
+        pending["remaining"] -= 1
+        if pending["remaining"] == 0:
+            self.complete_course(course)
+
+    def complete_course(self, course):
+        """Stores the files and validators of a course once all of its file details are known."""
+        pending = self.pending_courses.pop(course.id)
+        self.db.store_files(pending["new"], pending["updated"])
+        if pending["validators"] is not None:
+            self.db.set_folder_validators(course.id, pending["validators"])
+            self.db.set_course_sync_time(course.id, self.update_time)
+        self.db.commit()
+
+
+    def download_tasks(self):
+        """Returns one task for each file that has not been fetched in its current version."""
+        store = BlobStore(self.sync_dir)
+        os.makedirs(store.blobs_dir, exist_ok=True)
+        stats = StatCache()
+        dirs, stored_blobs = stats.listdir(store.blobs_dir)
+        stored_blobs = set(stored_blobs)
+        # The blob store changes while fetching, so the listing is not shared with checkout
+        if self.tracer is not None:
+            self.tracer.syscalls.update(stats.syscalls)
+
+        file_blobs = self.db.list_file_blobs()
+        pending_files = [ f for f in self.db.iter_files([ "id", "name", "description",
+                    "remote_date", "local_date", "version" ],
+                select_sync_metadata_only=False, select_sync_no=False)
+                if file_blobs.get(f.id) not in stored_blobs
+                    or not f.local_date or f.local_date != f.remote_date ]
+
+        # Existing blobs by size and partial hash, for recognizing duplicates while downloading.
+        # Workers only read this, new blobs are added from the main thread.
+        self.blobs_by_size = {}
+        for blob in self.db.list_blobs():
+            if blob.hash in stored_blobs:
+                self.blobs_by_size.setdefault(blob.size, {})[blob.partial_hash] = blob
+
+        self.stored_partial_downloads = self.db.list_partial_downloads()
+        self.files_downloaded = 0
+        self.files_to_download = len(pending_files)
+
+        return [ { "file": file, "store": store,
+                "part_path": store.part_path(file.id, file.version),
+                "partial": self.stored_partial_downloads.get(file.id),
+                "blobs_by_size": self.blobs_by_size,
+                "url": self.studip_url("/studip/sendfile.php?force_download=1&type=0&" \
+                        + urlencode({"file_id": file.id, "file_name": file.name }))
+            } for file in pending_files ]
+
+    def handle_download(self, file, blob):
+        self.files_downloaded += 1
+        print("Fetched file {}/{}: {}".format(self.files_downloaded, self.files_to_download,
+                ellipsize(file.description, 50)))
+
+        self.db.set_file_blob(file.id, file.version, blob)
+        self.blobs_by_size.setdefault(blob.size, {})[blob.partial_hash] = blob
+        self.db.update_file_local_date(file)
+        if file.id in self.stored_partial_downloads:
+            self.db.remove_partial_download(file.id)
+        # Committed at the latest by store_partial_downloads(). If the client crashes before, the
+        # file is fetched again and deduplicated into its existing blob.
+        self.db.group_commit()
+
+    def store_partial_downloads(self, partial_downloads):
+        """Remembers what is needed to resume the downloads that were interrupted."""
+        for file_id, partial in partial_downloads.items():
+            self.db.set_partial_download(file_id, partial)
+        self.db.commit()
+
+
+    def close(self):
+        pass
+
+
+class Session(SessionBase):
+    """Sends requests through blocking requests sessions, using thread pools for concurrency."""
+
+    def __init__(self, config, db, user_name, password, sync_dir, tracer=None,
+            new_transport=None):
+        super().__init__(config, db, sync_dir, tracer)
+
+        # Creates the transport adapter for each requests session, see http_session()
+        self.new_transport = new_transport
+        self.http = http_session(tracer, new_transport)
 
-        concurrency = int(self.config["connection", "update_concurrency"])
-        with SessionPool(concurrency, self.http.cookies) as pool:
-            for course in sync_courses:
-                course_url = self.studip_url("/studip/seminar_main.php?auswahl=" + course.id)
-                folder_url = self.studip_url("/studip/folder.php?cid=" + course.id + "&cmd=all")
-
-                try:
-                    self.http.get(course_url, timeout=(None, 0.001))
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                except Timeout:
-                    pass
-                except RequestException as e:
-                    raise SessionError("Unable to set course: {}".format(str(e)))
-
-                r = self.http.get(folder_url)
-                try:
-                    file_list = parse_file_list(r.text)
-                except ParserError:
-                    raise SessionError("Unable to parse file list")
-
-                if last_course_synced:
-                    print()
-
-                new_files = [ file_id for file_id, _ in file_list if file_id not in db_file_dict ]
-                updated_files = [ file_id for file_id, date in file_list
-                        if file_id  in db_file_dict and db_file_dict[file_id].remote_date != date ]
-
-                if len(new_files) > 0:
-                    new_files_str = ("" if last_course_synced else "\n") + str(len(new_files))
-                    last_course_synced = True
-                else:
-                    new_files_str = "No"
-                    last_course_synced = False
-
-                updated_files_str = ""
-                if len(updated_files) > 0:
-                    updated_files_str = ", {} updated ".format(len(updated_files))
-
-                print("{} new{} file(s) for {} {} ".format(new_files_str, updated_files_str,
-                        course.type, course.name))
-
-                files_to_fetch = new_files + updated_files
-                for file_id in files_to_fetch:
-                    pool.defer_request("GET", folder_url + "&open=" + file_id)
-                pool.done()
-
-                for i, request in enumerate(pool):
-                    try:
-                        file = parse_file_details(course.id, request.text)
-                    except ParserError:
-                        raise SessionError("Unable to parse file details")
-
-                    print("Fetched metadata for file {}/{}: ".format(i+1, len(files_to_fetch)),
-                            end="", flush=True)
-                    if file.complete():
-                        if file.id in new_files:
-                            self.db.add_file(file)
-                        else:
-                            self.db.update_file(file)
-                        print(" " + file.description)
-                    else:
-                        print(" <bad format>")
+        try:
+            r = self.http.get(self.login_url())
+        except RequestException as e:
+            raise_fetch_error("login page", e)
 
+        post_url = self.parse_login_page(r.text)
 
-    def fetch_files(self):
-        first_file = True
-        files_dir = path.join(self.sync_dir, ".studip", "files")
-        os.makedirs(files_dir, exist_ok=True)
-
-        sync_files = self.db.list_files(full=True, select_sync_metadata_only=False,
-                select_sync_no=False)
-        sync_file_paths = ((f, path.join(files_dir, f.id)
-                + ("."  + str(f.version) if f.version > 0 else "")) for f in sync_files)
-        sync_file_updates = ((f, p, path.isfile(p), not f.local_date
-                or f.local_date != f.remote_date) for (f, p) in sync_file_paths)
-        pending_files = [(f, p, exists, update) for (f, p, exists, update) in sync_file_updates
-                if not exists or update]
-
-        for i, (file, file_path, exists, update) in enumerate(pending_files):
-            if first_file:
-                print()
-                first_file = False
-            print("Fetching file {}/{}: {}...".format(i+1, len(pending_files),
-                    ellipsize(file.description, 50)))
-
-            url = self.studip_url("/studip/sendfile.php?force_download=1&type=0&" \
-                    + urlencode({"file_id": file.id, "file_name": file.name }))
-            try:
-                r = self.http.get(url)
-            except RequestException as e:
-                raise SessionError("Unable to download file {}: {}".format(file.name, e))
+        try:
+            r = self.http.post(post_url, data=self.login_credentials(user_name, password))
+        except RequestException as e:
+            raise_fetch_error("login confirmation page", e)
+
+        form_data = self.parse_login_response(r.text)
+
+        try:
+            r = self.http.post(self.saml_url(), form_data)
+        except RequestException as e:
+            raise_fetch_error("login page", e)
 
-            with open(file_path, "wb") as writer:
-                writer.write(r.content)
 
-            file.local_date = file.remote_date
+    def update_metadata(self):
+        try:
+            overview_page = self.http.post(self.overview_url(),
+                    data={ "sem_select": "current" }).text
+        except RequestException as e:
+            raise_fetch_error("overview page", e)
+
+        self.update_course_list(overview_page)
 
-            timestamp = time.mktime(file.local_date.timetuple())
-            os.utime(file_path, (timestamp, timestamp))
+        # Folder lists of all courses are requested up front, and the details of each course's
+        # new files are queued as soon as its list arrives, so both kinds of requests overlap
+        concurrency = int(self.config["connection", "update_concurrency"])
+        with MetadataPool(concurrency, self.http.cookies, tracer=self.tracer,
+                new_transport=self.new_transport) as pool:
+            for task, result in pool.map(self.metadata_tasks()):
+                if task["type"] == "folder":
+                    for details_task in self.handle_file_list(task, *result):
+                        pool.submit(details_task)
+                else: # task["type"] == "details"
+                    self.handle_file_details(task, result)
+
+
+    def fetch_files(self):
+        downloads = self.download_tasks()
+        if not downloads:
+            return
+
+        print()
+        concurrency = int(self.config["connection", "fetch_concurrency"])
+        pool = DownloadPool(concurrency, self.http.cookies, tracer=self.tracer,
+                new_transport=self.new_transport)
+        try:
+            with pool:
+                # Downloads complete in arbitrary order. The database connection is only ever
+                # touched from this thread, so each finished file is committed here.
+                for _, (file, blob) in pool.map(downloads):
+                    self.handle_download(file, blob)
+        finally:
+            self.store_partial_downloads(pool.partial_downloads)
 
-            self.db.update_file_local_date(file)
-            self.db.commit()
 
+    def close(self):
+        self.http.close()
@@ -0,0 +1,19 @@
+BEGIN TRANSACTION;
+
+CREATE TABLE partial_downloads (
+    file CHAR(32) NOT NULL,
+    version INTEGER NOT NULL,
+    size INTEGER,
+    etag VARCHAR(128),
+    last_modified VARCHAR(64),
+    PRIMARY KEY (file ASC),
+    FOREIGN KEY (file) REFERENCES files(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER cleanup_partial_downloads_files
+BEFORE DELETE ON files
+BEGIN
+    DELETE FROM partial_downloads WHERE file = old.id;
+END;
+
+COMMIT TRANSACTION;
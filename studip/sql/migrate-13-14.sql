@@ -0,0 +1,12 @@
+BEGIN TRANSACTION;
+
+ALTER TABLE courses
+ADD COLUMN folder_etag VARCHAR(128);
+
+ALTER TABLE courses
+ADD COLUMN folder_last_modified VARCHAR(64);
+
+ALTER TABLE courses
+ADD COLUMN folder_hash CHAR(40);
+
+COMMIT TRANSACTION;
@@ -0,0 +1,6 @@
+BEGIN TRANSACTION;
+
+ALTER TABLE courses
+ADD COLUMN last_sync TIMESTAMP;
+
+COMMIT TRANSACTION;
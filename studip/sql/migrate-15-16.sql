@@ -0,0 +1,65 @@
+BEGIN TRANSACTION;
+
+-- Folders store their course and their path below the course root, with components separated by
+-- char(31), instead of having both computed recursively by folder_paths
+
+DROP VIEW file_details;
+DROP VIEW folder_paths;
+DROP VIEW folder_parents;
+
+ALTER TABLE folders
+ADD COLUMN course CHAR(32);
+
+ALTER TABLE folders
+ADD COLUMN path TEXT;
+
+CREATE TEMP TABLE folder_paths_migrate (
+    id INTEGER NOT NULL,
+    course CHAR(32),
+    path TEXT,
+    PRIMARY KEY (id ASC)
+);
+
+INSERT INTO folder_paths_migrate (id, course, path)
+    WITH RECURSIVE paths (id, course, path) AS (
+        SELECT folders.id, courses.id, ''
+            FROM folders
+            INNER JOIN courses ON courses.root = folders.id
+        UNION ALL
+        SELECT folders.id, paths.course,
+                CASE WHEN paths.path = '' THEN folders.name
+                    ELSE paths.path || char(31) || folders.name END
+            FROM folders
+            INNER JOIN paths ON folders.parent = paths.id
+    )
+    SELECT id, course, path FROM paths;
+
+UPDATE folders
+SET course = (SELECT course FROM folder_paths_migrate AS m WHERE m.id = folders.id),
+    path = (SELECT path FROM folder_paths_migrate AS m WHERE m.id = folders.id);
+
+DROP TABLE folder_paths_migrate;
+
+DROP TRIGGER create_root_folder;
+
+CREATE TRIGGER create_root_folder
+AFTER INSERT ON courses WHEN new.root IS NULL
+BEGIN
+    -- INSERT INTO ... DEFAULT VALUES is not supported inside triggers
+    INSERT INTO folders (parent, course, path) VALUES (NULL, new.id, '');
+    UPDATE courses SET root = last_insert_rowid() WHERE id = new.id;
+END;
+
+CREATE VIEW file_details AS
+    SELECT f.id AS id, c.id AS course_id, s.name AS course_semester, c.name AS course_name,
+            c.abbrev AS course_abbrev, c.type AS course_type, c.type_abbrev as course_type_abbrev,
+            p.path AS path, f.name AS name, f.extension AS extension,
+            f.author AS author, f.description AS description, f.remote_date AS remote_date,
+            f.copyrighted AS copyrighted, f.local_date as local_date, f.version AS version,
+            c.sync AS sync
+    FROM files AS f
+    INNER JOIN folders AS p ON f.folder = p.id
+    INNER JOIN courses AS c ON p.course = c.id
+    INNER JOIN semesters AS s ON c.semester = s.id;
+
+COMMIT TRANSACTION;
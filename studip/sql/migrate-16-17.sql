@@ -0,0 +1,29 @@
+BEGIN TRANSACTION;
+
+ALTER TABLE checkouts
+ADD COLUMN path TEXT;
+
+ALTER TABLE checkouts
+ADD COLUMN device INTEGER;
+
+ALTER TABLE checkouts
+ADD COLUMN inode INTEGER;
+
+ALTER TABLE checkouts
+ADD COLUMN mtime REAL;
+
+CREATE TABLE view_directories (
+    view INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (view, path),
+    FOREIGN KEY (view) REFERENCES views(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER cleanup_view_directories_views
+BEFORE DELETE ON views
+BEGIN
+    DELETE FROM view_directories WHERE view = old.id;
+END;
+
+COMMIT TRANSACTION;
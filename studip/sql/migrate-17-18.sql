@@ -0,0 +1,25 @@
+BEGIN TRANSACTION;
+
+CREATE TABLE blobs (
+    hash CHAR(64) NOT NULL,
+    size INTEGER NOT NULL,
+    partial_hash CHAR(64) NOT NULL,
+    PRIMARY KEY (hash ASC)
+) WITHOUT ROWID;
+
+CREATE TABLE file_blobs (
+    file CHAR(32) NOT NULL,
+    version INTEGER NOT NULL,
+    blob CHAR(64) NOT NULL,
+    PRIMARY KEY (file, version),
+    FOREIGN KEY (file) REFERENCES files(id),
+    FOREIGN KEY (blob) REFERENCES blobs(hash)
+) WITHOUT ROWID;
+
+CREATE TRIGGER cleanup_file_blobs_files
+BEFORE DELETE ON files
+BEGIN
+    DELETE FROM file_blobs WHERE file = old.id;
+END;
+
+COMMIT TRANSACTION;
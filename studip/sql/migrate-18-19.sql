@@ -0,0 +1,9 @@
+BEGIN TRANSACTION;
+
+CREATE INDEX folders_course_path ON folders (course, path);
+
+CREATE INDEX files_folder ON files (folder);
+
+CREATE INDEX checkouts_file ON checkouts (file);
+
+COMMIT TRANSACTION;
@@ -26,6 +26,10 @@ CREATE TABLE IF NOT EXISTS courses (
     type_abbrev VARCHAR(4),
     sync SMALLINT NOT NULL,
     root INTEGER,
+    folder_etag VARCHAR(128),
+    folder_last_modified VARCHAR(64),
+    folder_hash CHAR(40),
+    last_sync TIMESTAMP,
     PRIMARY KEY (id ASC),
     FOREIGN KEY (semester) REFERENCES semesters(id),
     FOREIGN KEY (root) REFERENCES folders(id)
@@ -47,31 +51,48 @@ CREATE TABLE IF NOT EXISTS files (
     FOREIGN KEY (folder) REFERENCES folders(id)
 ) WITHOUT ROWID;
 
+-- path holds the names of all folders from the course root (exclusive) down to this folder,
+-- separated by char(31)
 CREATE TABLE IF NOT EXISTS folders (
     id INTEGER NOT NULL,
     name VARCHAR(128),
     parent INTEGER,
+    course CHAR(32),
+    path TEXT,
     PRIMARY KEY (id ASC),
     FOREIGN KEY (parent) REFERENCES folders(id),
     CHECK ((name IS NULL) == (parent IS NULL))
 );
 
+-- Folders of a course are looked up by their materialized path
+CREATE INDEX IF NOT EXISTS folders_course_path ON folders (course, path);
+
+-- Joins from folders to their files
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+
 CREATE TRIGGER IF NOT EXISTS create_root_folder
 AFTER INSERT ON courses WHEN new.root IS NULL
 BEGIN
     -- INSERT INTO ... DEFAULT VALUES is not supported inside triggers
-    INSERT INTO folders (parent) VALUES (NULL);
+    INSERT INTO folders (parent, course, path) VALUES (NULL, new.id, '');
     UPDATE courses SET root = last_insert_rowid() WHERE id = new.id;
 END;
 
 CREATE TABLE IF NOT EXISTS checkouts (
     view INTEGER NOT NULL,
     file id CHAR(32) NOT NULL,
+    path TEXT,
+    device INTEGER,
+    inode INTEGER,
+    mtime REAL,
     PRIMARY KEY (view, file),
     FOREIGN KEY (view) REFERENCES views(id),
     FOREIGN KEY (file) REFERENCES files(id)
 ) WITHOUT ROWID;
 
+-- Checkouts are removed by file when the file is updated or deleted
+CREATE INDEX IF NOT EXISTS checkouts_file ON checkouts (file);
+
 CREATE TRIGGER IF NOT EXISTS cleanup_checkouts_views
 BEFORE DELETE ON views
 BEGIN
@@ -84,30 +105,57 @@ BEGIN
     DELETE FROM checkouts WHERE file = old.id;
 END;
 
-CREATE VIEW IF NOT EXISTS folder_parents AS
-    WITH RECURSIVE parents (folder, level, this, parent) AS (
-        SELECT id, 0, id, parent
-            FROM folders
-        UNION ALL
-        SELECT parents.folder, parents.level + 1, folders.id, folders.parent
-            FROM folders
-            INNER JOIN parents ON folders.id = parents.parent
-    )
-    SELECT folder, level, this FROM parents;
-
-CREATE VIEW IF NOT EXISTS folder_paths AS
-    SELECT list.folder AS folder,
-        MAX(courses.id) AS course,
-        '[' || IFNULL(GROUP_CONCAT('"' || REPLACE(REPLACE(folders.name, '\', '\\'),
-            '"', '\"') || '"', ', '), '') || ']' AS path
-    FROM (
-        SELECT parents.folder AS folder, parents.this AS this
-        FROM folder_parents AS parents
-        ORDER BY level DESC
-    ) AS list
-    INNER JOIN folders ON folders.id = list.this
-    LEFT OUTER JOIN courses ON courses.root = folders.id
-    GROUP BY folder;
+CREATE TABLE IF NOT EXISTS blobs (
+    hash CHAR(64) NOT NULL,
+    size INTEGER NOT NULL,
+    partial_hash CHAR(64) NOT NULL,
+    PRIMARY KEY (hash ASC)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS file_blobs (
+    file CHAR(32) NOT NULL,
+    version INTEGER NOT NULL,
+    blob CHAR(64) NOT NULL,
+    PRIMARY KEY (file, version),
+    FOREIGN KEY (file) REFERENCES files(id),
+    FOREIGN KEY (blob) REFERENCES blobs(hash)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS cleanup_file_blobs_files
+BEFORE DELETE ON files
+BEGIN
+    DELETE FROM file_blobs WHERE file = old.id;
+END;
+
+CREATE TABLE IF NOT EXISTS view_directories (
+    view INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    PRIMARY KEY (view, path),
+    FOREIGN KEY (view) REFERENCES views(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS cleanup_view_directories_views
+BEFORE DELETE ON views
+BEGIN
+    DELETE FROM view_directories WHERE view = old.id;
+END;
+
+CREATE TABLE IF NOT EXISTS partial_downloads (
+    file CHAR(32) NOT NULL,
+    version INTEGER NOT NULL,
+    size INTEGER,
+    etag VARCHAR(128),
+    last_modified VARCHAR(64),
+    PRIMARY KEY (file ASC),
+    FOREIGN KEY (file) REFERENCES files(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS cleanup_partial_downloads_files
+BEFORE DELETE ON files
+BEGIN
+    DELETE FROM partial_downloads WHERE file = old.id;
+END;
 
 CREATE VIEW IF NOT EXISTS file_details AS
     SELECT f.id AS id, c.id AS course_id, s.name AS course_semester, c.name AS course_name,
@@ -117,7 +165,7 @@ CREATE VIEW IF NOT EXISTS file_details AS
             f.copyrighted AS copyrighted, f.local_date as local_date, f.version AS version,
             c.sync AS sync
     FROM files AS f
-    INNER JOIN folder_paths AS p ON f.folder = p.folder
+    INNER JOIN folders AS p ON f.folder = p.id
     INNER JOIN courses AS c ON p.course = c.id
     INNER JOIN semesters AS s ON c.semester = s.id;
 
@@ -0,0 +1,189 @@
+import time, json, re, threading
+
+from collections import Counter
+from contextlib import contextmanager
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of a non-empty list of values by the nearest-rank method."""
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(len(values) * p / 100 + 0.5) - 1))]
+
+
+class Tracer:
+    """Collects timings and counters of a single run for the --stats and --trace options.
+
+    Phases are the steps of an operation such as login, update, fetch and checkout, nested phases
+    are named like "checkout/scan". Each HTTP request is recorded with its kind (login, overview,
+    course, folder, detail or sendfile) and its latency until the response headers arrived.
+    Response bodies are often streamed, so received bytes are counted separately per kind.
+
+    record_request() and add_bytes() may be called from worker threads."""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phase_stack = []
+        self.phases = []
+        self.requests = []
+        self.bytes = Counter()
+        self.db_statements = Counter()
+        self.syscalls = Counter()
+
+    def now(self):
+        return time.perf_counter() - self.start
+
+    @contextmanager
+    def phase(self, name):
+        self.phase_stack.append(name)
+        full_name = "/".join(self.phase_stack)
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.phases.append((full_name, start, self.now() - start))
+            self.phase_stack.pop()
+
+    def record_request(self, kind, start, latency, status=None):
+        """Records a request that was sent start seconds after now() started counting."""
+        with self.lock:
+            self.requests.append((kind, start, latency, status))
+
+    def add_bytes(self, kind, count):
+        with self.lock:
+            self.bytes[kind] += count
+
+    def count_statement(self, sql):
+        """Trace callback for the database connection, counts statements by their verb."""
+        words = sql.split(None, 1)
+        self.db_statements[words[0].upper() if words else ""] += 1
+
+    def request_stats(self):
+        latencies = {}
+        for kind, _, latency, _ in self.requests:
+            latencies.setdefault(kind, []).append(latency)
+
+        stats = {}
+        for kind in sorted(set(latencies) | set(self.bytes)):
+            values = latencies.get(kind, [])
+            stats[kind] = {
+                "count": len(values),
+                "total": sum(values),
+                "mean": sum(values) / len(values) if values else 0,
+                "p95": percentile(values, 95) if values else 0,
+                "max": max(values, default=0),
+                "bytes": self.bytes[kind]
+            }
+        return stats
+
+    def as_dict(self):
+        return {
+            "started": self.start_time,
+            "duration": self.now(),
+            "phases": [ { "name": name, "start": start, "duration": duration }
+                    for name, start, duration in sorted(self.phases, key=lambda p: p[1]) ],
+            "requests": [ { "kind": kind, "start": start, "latency": latency, "status": status }
+                    for kind, start, latency, status in self.requests ],
+            "request_stats": self.request_stats(),
+            "db_statements": dict(self.db_statements),
+            "syscalls": dict(self.syscalls)
+        }
+
+    def write(self, file_name):
+        with open(file_name, "w", encoding="utf-8") as file:
+            json.dump(self.as_dict(), file, indent=1)
+            file.write("\n")
+
+    def summary(self):
+        lines = [ "", "{:28} {:>9}".format("Phase", "Time") ]
+        for name, _, duration in sorted(self.phases, key=lambda p: p[1]):
+            lines.append("{:28} {:>8.2f}s".format("  " * name.count("/") + name.split("/")[-1],
+                    duration))
+        lines.append("{:28} {:>8.2f}s".format("total", self.now()))
+
+        request_stats = self.request_stats()
+        if request_stats:
+            fmt = "{:10} {:>7} {:>9} {:>9} {:>9} {:>9} {:>12}"
+            lines += [ "", fmt.format("Requests", "count", "total", "mean", "p95", "max",
+                    "bytes") ]
+            for kind, s in request_stats.items():
+                lines.append(fmt.format(kind, s["count"], *("{:.3f}s".format(s[k])
+                        for k in [ "total", "mean", "p95", "max" ]), s["bytes"]))
+
+        for title, counter in [ ("Database statements", self.db_statements),
+                ("File system calls", self.syscalls) ]:
+            if counter:
+                lines += [ "", "{}: {}".format(title, sum(counter.values())) ]
+                lines.append("  " + ", ".join("{} {}".format(k, v)
+                        for k, v in counter.most_common()))
+        return "\n".join(lines)
+
+
+class QueryProfiler:
+    """Aggregates the time spent in each database statement for the --profile-sql option.
+
+    Statements are grouped after collapsing whitespace, literals and the parameter lists of IN
+    clauses, so that queries assembled for different filters still end up in the same group. The
+    recorded time includes fetching the rows of a query, but not the caller's work in between.
+
+    For as many statements as given by explain, starting with the one that took longest in total,
+    the report includes the output of EXPLAIN QUERY PLAN with the parameters of their slowest
+    execution."""
+
+    def __init__(self, explain=5):
+        self.explain = explain
+        self.statements = {}
+
+    @staticmethod
+    def normalize(sql):
+        sql = re.sub(r"\s+", " ", sql).strip()
+        sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+        sql = re.sub(r"(?<![\w:])\d+(?:\.\d+)?\b", "?", sql)
+        return re.sub(r"\bIN \(\s*[?:]\w*(?:\s*,\s*[?:]\w*)*\s*\)", "IN (...)", sql)
+
+    def record(self, sql, elapsed, rows, params=None, script=False):
+        """Records one execution of a statement, or of a whole script if script is set. Scripts
+        consist of several statements and are never explained."""
+        key = self.normalize(sql)
+        s = self.statements.get(key)
+        if s is None:
+            s = self.statements[key] = { "times": [], "rows": 0, "slowest": -1, "sql": None,
+                    "params": None, "script": script }
+        s["times"].append(elapsed)
+        s["rows"] += max(rows, 0)
+        if elapsed > s["slowest"]:
+            s["slowest"], s["sql"], s["params"] = elapsed, sql, params
+
+    def report(self, explain_query=None):
+        """Returns the report as a string. explain_query(sql, params) returns the rows of EXPLAIN
+        QUERY PLAN for a statement, plans are left out without it."""
+        by_total = sorted(self.statements.items(), key=lambda s: sum(s[1]["times"]),
+                reverse=True)
+
+        fmt = "{:>7} {:>9} {:>9} {:>8}  {}"
+        lines = [ "", "SQL statements by total time", fmt.format("count", "total", "p95", "rows",
+                "statement") ]
+        for key, s in by_total:
+            lines.append(fmt.format(len(s["times"]), "{:.4f}s".format(sum(s["times"])),
+                    "{:.4f}s".format(percentile(s["times"], 95)), s["rows"],
+                    key if len(key) <= 80 else key[:77] + "..."))
+
+        if explain_query is not None and self.explain > 0:
+            explained = [ (key, s) for key, s in by_total if not s["script"] ][:self.explain]
+            for key, s in explained:
+                lines += [ "", "{} ({:.4f}s total)".format(key, sum(s["times"])) ]
+                try:
+                    plan = explain_query(s["sql"], s["params"])
+                except Exception as e:
+                    lines.append("  Query plan not available: {}".format(e))
+                    continue
+
+                if not plan:
+                    lines.append("  (no query plan)")
+                # Rows are (id, parent, unused, detail), children follow their parent
+                depth = { 0: 0 }
+                for id, parent, _, detail in plan:
+                    depth[id] = depth.get(parent, 0) + 1
+                    lines.append("  " * depth[id] + detail)
+        return "\n".join(lines)
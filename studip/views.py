@@ -1,211 +1,496 @@
-import os,time, re
+import os, stat, time, re
 
 from os import path
+from itertools import chain
+from string import Formatter
 
 from .util import ellipsize, escape_file_name, lexicalise_semester
+from .fs import StatCache
+from .database import Course, Checkout
+from .executor import Executor
+from .blobs import BlobStore
+from .session import SessionError
+
+
+def same_checkout(a, b):
+    return (a.path, a.device, a.inode, a.mtime) == (b.path, b.device, b.inode, b.mtime)
+
+
+class FetchedFiles:
+    """The known files whose current version is in the blob store, shared between all views.
+
+    Only the names of the blobs are listed up front, the inodes are looked up once a link in a
+    view has to be identified."""
+
+    def __init__(self, sync_dir, db, stats):
+        self.store = BlobStore(sync_dir)
+        self.stats = stats
+
+        try:
+            dirs, names = self.stats.listdir(self.store.blobs_dir)
+        except FileNotFoundError:
+            names = []
+        names = set(names)
+
+        self.blobs = db.list_file_blobs()
+        self.files = [ f for f in db.list_files(full=True, select_sync_metadata_only=False,
+                select_sync_no=False) if self.blobs.get(f.id) in names ]
+        self.by_inode = None
+
+    def path(self, file):
+        return self.store.path(self.blobs[file.id])
+
+    def find(self, st):
+        """Returns the fetched files a hard link with the given stat result points to. Files with
+        identical contents share a blob and thus an inode."""
+        if self.by_inode is None:
+            # Hard links are identified by device and inode number
+            self.by_inode = {}
+            for f in self.files:
+                fst = self.stats.lstat(self.path(f))
+                if fst is not None and stat.S_ISREG(fst.st_mode):
+                    self.by_inode.setdefault((fst.st_dev, fst.st_ino), []).append(f)
+        return self.by_inode.get((st.st_dev, st.st_ino), [])
+
+
+class LinkPool(Executor):
+    def execute_task(self, local_state, task):
+        try:
+            os.link(task["source"], task["target"])
+        except FileExistsError:
+            # E.g. names that only differ in case on a case-insensitive file system
+            return False
+        return True
+
+
+def checkout_views(synchronizers):
+    """Checks out new files into several views in one pass.
+
+    Directories are created up front, the hard links are then created from a pool of worker
+    threads."""
+    tasks = []
+    targets = set()
+    try:
+        for sync in synchronizers:
+            # Several new files can map to the same path, e.g. with a format that ignores the
+            # version. As with paths that already exist, the first one wins.
+            for task in sync.prepare_checkout():
+                if task["target"] not in targets:
+                    targets.add(task["target"])
+                    tasks.append(task)
+
+        if tasks:
+            print()
+            with LinkPool() as pool:
+                for i, (task, linked) in enumerate(pool.map(tasks)):
+                    if not linked:
+                        print("Skipping file {}/{}: {} already exists".format(i+1, len(tasks),
+                                task["target"]))
+                        continue
+                    print("Checking out file {}/{}: {}...".format(i+1, len(tasks),
+                            ellipsize(task["file"].description, 50)))
+                    task["sync"].link_done(task)
+    finally:
+        for sync in synchronizers:
+            sync.finish_checkout()
+
+    if synchronizers:
+        courses = synchronizers[0].db.list_courses(full=True, select_sync_metadata_only=False,
+                select_sync_no=False)
+        for sync in synchronizers:
+            sync.create_course_folders(courses)
+
+
+FIELD_NAME_RE = re.compile(r"[^.\[]*")
+
+ALL_FILES_FOLDER = "Allgemeiner Dateiordner"
+
+
+def short_folder_path(fmt, folders):
+    if folders and folders[0] == ALL_FILES_FOLDER:
+        folders = folders[1:]
+    return fmt.folder_path(folders)
+
+
+def file_extension(fmt, file):
+    extension = ("." + file.extension) if file.extension else ""
+    if file.version > 0:
+        extension = fmt.escape(" (StudIP Version {})".format(file.version + 1)) + extension
+    return extension
+
+
+def description_without_extension(fmt, file):
+    descr_no_ext = file.description
+    if descr_no_ext.endswith("." + file.extension):
+        descr_no_ext = descr_no_ext[:-1-len(file.extension)]
+    return fmt.escape(descr_no_ext)
+
+
+# Tokens that only depend on the course, evaluated for a Course object
+COURSE_TOKENS = {
+    "semester": lambda fmt, c: fmt.escape(c.semester),
+    "semester-lexical": lambda fmt, c: fmt.escape(lexicalise_semester(c.semester)),
+    "semester-lexical-short": lambda fmt, c: fmt.escape(lexicalise_semester(c.semester,
+            short=True)),
+    "course-id": lambda fmt, c: c.id,
+    "course-abbrev": lambda fmt, c: fmt.escape(c.abbrev),
+    "course": lambda fmt, c: fmt.escape(c.name),
+    "type": lambda fmt, c: fmt.escape(c.type),
+    "type-abbrev": lambda fmt, c: fmt.escape(c.type_abbrev),
+}
+
+FILE_TOKENS = {
+    "path": lambda fmt, f: fmt.folder_path(f.path),
+    "short-path": lambda fmt, f: short_folder_path(fmt, f.path),
+    "id": lambda fmt, f: f.id,
+    "name": lambda fmt, f: fmt.escape(f.name),
+    "ext": file_extension,
+    "description": lambda fmt, f: fmt.escape(f.description),
+    "descr-no-ext": description_without_extension,
+    "author": lambda fmt, f: fmt.escape(f.author),
+    "time": lambda fmt, f: fmt.escape(str(f.local_date)),
+}
+
+# File tokens for the dummy file used to find the folder of a course
+DUMMY_FILE_TOKENS = {
+    "path": lambda fmt: "",
+    "short-path": lambda fmt: "",
+    "id": lambda fmt: "0" * 32,
+    "name": lambda fmt: "dummy",
+    "ext": lambda fmt: "txt",
+    "description": lambda fmt: "dummy.txt",
+    "descr-no-ext": lambda fmt: "dummy",
+    "author": lambda fmt: "A",
+    "time": lambda fmt: fmt.escape("0000-00-00 00:00:00"),
+}
+
+
+class PathFormat:
+    """A view's path format, parsed once.
+
+    Only the tokens referenced by the format are evaluated. Course tokens and folder paths are
+    escaped once and then reused for every file of the same course or folder."""
+
+    def __init__(self, view):
+        self.view = view
+        try:
+            fields = [ f for _, f, _, _ in Formatter().parse(view.format) if f is not None ]
+        except ValueError:
+            self.invalid()
+
+        names = set(FIELD_NAME_RE.match(f).group() for f in fields)
+        if not names <= COURSE_TOKENS.keys() | FILE_TOKENS.keys():
+            self.invalid()
+
+        self.course_tokens = [ (n, COURSE_TOKENS[n]) for n in names if n in COURSE_TOKENS ]
+        self.file_tokens = [ (n, FILE_TOKENS[n]) for n in names if n in FILE_TOKENS ]
+        self.dummy_tokens = dict((n, DUMMY_FILE_TOKENS[n](self)) for n, _ in self.file_tokens)
+        self.courses = {}
+        self.folders = {}
+
+    def invalid(self):
+        raise SessionError("Invalid path format: " + self.view.format)
+
+    def escape(self, str):
+        return escape_file_name(str, self.view.charset, self.view.escape)
+
+    def folder_path(self, folders):
+        try:
+            return self.folders[folders]
+        except KeyError:
+            folder_path = path.join(*map(self.escape, folders)) if folders else ""
+            self.folders[folders] = folder_path
+            return folder_path
+
+    def course_values(self, course_id, get_course):
+        try:
+            return self.courses[course_id]
+        except KeyError:
+            course = get_course()
+            values = dict((n, f(self, course)) for n, f in self.course_tokens)
+            self.courses[course_id] = values
+            return values
+
+    def render(self, tokens):
+        try:
+            return self.view.format.format(**tokens)
+        except Exception:
+            self.invalid()
+
+    def format_file(self, file):
+        tokens = dict(self.course_values(file.course, lambda: Course(file.course,
+                semester=file.course_semester, name=file.course_name, abbrev=file.course_abbrev,
+                type=file.course_type, type_abbrev=file.course_type_abbrev)))
+        for n, f in self.file_tokens:
+            tokens[n] = f(self, file)
+        return self.render(tokens)
+
+    def format_course(self, course):
+        tokens = dict(self.course_values(course.id, lambda: course))
+        tokens.update(self.dummy_tokens)
+        return self.render(tokens)
 
 
 class ViewSynchronizer:
-    def __init__(self, sync_dir, config, db, view):
+    def __init__(self, sync_dir, config, db, view, stats=None, fetched=None):
         self.sync_dir = sync_dir
         self.config = config
         self.db = db
         self.view = view
+        self.stats = stats if stats is not None else StatCache()
+        self.fetched = fetched if fetched is not None else FetchedFiles(sync_dir, db, self.stats)
         self.meta_dir = path.join(self.sync_dir, ".studip")
-        self.files_dir = path.join(self.meta_dir, "files")
-        self.view_dir = path.join(self.sync_dir, self.view.base if self.view.base else "")
-
-        # Find all known files that have been fetched into .studip/files
-        fetched_files = []
-        for file in self.db.list_files(full=True, select_sync_metadata_only=False,
-                select_sync_no=False):
-            file_name = file.id
-            if file.version > 0:
-                file_name += "." + str(file.version)
-            abs_path = path.join(self.files_dir, file_name)
-            if path.isfile(abs_path):
-                file.inode = os.lstat(abs_path).st_ino
-                fetched_files.append(file)
-
-        # Find all files hardlinked to a fetched file within the view's directory, tree
-        self.existing_files = []
-        for cwd, dirs, files in os.walk(self.view_dir):
-            if cwd.startswith(self.meta_dir): continue
-
-            for f in files:
-                abs_path = os.path.join(cwd, f)
-                inode = os.lstat(abs_path).st_ino
-                existing = next((f for f in fetched_files if f.inode == inode), None)
-                if existing:
-                    self.existing_files.append(existing)
+        self.view_dir = path.normpath(path.join(self.sync_dir,
+                self.view.base if self.view.base else ""))
+        self.compiled_format = None
+
+        # The database remembers where each file was checked out and the mtimes of all
+        # directories in the view. Unless the index is missing or incomplete (e.g. after a
+        # migration or reset-deleted), only the recorded paths and directories that have changed
+        # since the last run need to be looked at.
+        checkouts = self.db.list_checkouts(view.id)
+        directories = self.db.list_view_directories(view.id)
+        if directories and all(c.indexed() for c in checkouts.values()):
+            self.existing, self.directories = self.scan_changes(checkouts, directories)
+        else:
+            self.existing, self.directories = self.scan_all()
+
+        self.existing_files = [ f for f in self.fetched.files if f.id in self.existing ]
+        self.existing_inodes = set((c.device, c.inode) for c in self.existing.values())
 
         # From the checkouts db table, derive which files have been deleted and which
         # should be checked out
         self.new_files = []
         self.deleted_files = []
-
-        checked_out_files = self.db.list_checkouts(view.id)
-        for f in fetched_files:
-            # File is known, but not checked out
-            if not f in self.existing_files:
-                if f.id in checked_out_files:
+        for f in self.fetched.files:
+            if f.id not in self.existing:
+                if f.id in checkouts:
                     self.deleted_files.append(f)
                 else:
                     self.new_files.append(f)
-            # File is checked out, but we don't have a record of it (e.g. after reset-deleted)
-            elif f.id not in checked_out_files:
-                self.db.add_checkout(self.view.id, f.id)
 
+        # Record files that have been moved, or that are checked out without us having a record
+        # of it (e.g. after reset-deleted)
+        self.db.set_checkouts(self.view.id, [ c for c in self.existing.values()
+                if c.file not in checkouts or not same_checkout(c, checkouts[c.file]) ])
+        self.store_directories()
         self.db.commit()
 
-    def checkout(self):
+        self.new_checkouts = []
+        self.modified_folders = set()
+        self.copyrighted_files = []
+
+    def checkout_record(self, file_id, abs_path, st):
+        return Checkout(file_id, path.relpath(abs_path, self.view_dir), st.st_dev, st.st_ino,
+                st.st_mtime)
+
+    def scan_directory(self, dir, files, existing):
+        """Adds all files in dir that are hard links to a fetched file to existing."""
+        for f in files:
+            abs_path = path.join(dir, f)
+            st = self.stats.lstat(abs_path)
+            candidates = [ file for file in self.fetched.find(st) if file.id not in existing ]
+            if not candidates:
+                continue
+            # Files sharing the inode are told apart by the path the view would check them out at,
+            # a link that does not match any of them is attributed to the first one not yet found
+            file = candidates[0]
+            if len(candidates) > 1:
+                rel_path = path.relpath(abs_path, self.view_dir)
+                path_format = self.path_format()
+                file = next((c for c in candidates
+                        if path.normpath(path_format.format_file(c)) == rel_path), file)
+            existing[file.id] = self.checkout_record(file.id, abs_path, st)
+
+    def scan_all(self):
+        """Finds all files hardlinked to a fetched file within the view's directory tree."""
+        existing = {}
+        directories = {}
+        for cwd, dirs, files in self.stats.walk(self.view_dir, prune=(self.meta_dir,)):
+            self.scan_directory(cwd, files, existing)
+            directories[path.relpath(cwd, self.view_dir)] = None
+        return existing, directories
+
+    def scan_changes(self, checkouts, directories):
+        """Like scan_all(), but only stats the recorded checkouts and lists the directories whose
+        mtime has changed since the index was written."""
+        fetched_ids = set(f.id for f in self.fetched.files)
+        existing = {}
+        for c in checkouts.values():
+            if c.file not in fetched_ids:
+                continue
+            abs_path = path.join(self.view_dir, c.path)
+            st = self.stats.lstat(abs_path)
+            if st is None:
+                continue
+            if (st.st_dev, st.st_ino, st.st_mtime) == (c.device, c.inode, c.mtime) \
+                    or any(f.id == c.file for f in self.fetched.find(st)):
+                existing[c.file] = self.checkout_record(c.file, abs_path, st)
+
+        # Adding, removing or renaming an entry updates the mtime of the containing directory,
+        # so moved checkouts and new subdirectories can only be found in a changed directory.
+        scanned_directories = {}
+        for dir, mtime in directories.items():
+            abs_dir = path.normpath(path.join(self.view_dir, dir))
+            st = self.stats.lstat(abs_dir)
+            if st is None or not stat.S_ISDIR(st.st_mode):
+                continue
+            scanned_directories[dir] = mtime
+            if st.st_mtime == mtime:
+                continue
+
+            subdirs, files = self.stats.listdir(abs_dir)
+            self.scan_directory(abs_dir, files, existing)
+            for d in subdirs:
+                abs_subdir = path.join(abs_dir, d)
+                if path.relpath(abs_subdir, self.view_dir) in directories \
+                        or abs_subdir == self.meta_dir:
+                    continue
+                for cwd, _, files in self.stats.walk(abs_subdir, prune=(self.meta_dir,)):
+                    self.scan_directory(cwd, files, existing)
+                    scanned_directories[path.relpath(cwd, self.view_dir)] = None
+
+        return existing, scanned_directories
+
+    def store_directories(self):
+        directories = {}
+        for dir in self.directories:
+            st = self.stats.lstat(path.normpath(path.join(self.view_dir, dir)))
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                directories[dir] = st.st_mtime
+        self.directories = directories
+        self.db.set_view_directories(self.view.id, directories)
+
+    def makedirs(self, dir):
+        created = []
+        while self.stats.lstat(dir) is None:
+            created.append(dir)
+            dir = path.dirname(dir)
+        if not created:
+            return
+
+        os.makedirs(created[0], exist_ok=True)
+        self.stats.syscalls["mkdir"] += len(created)
+        for d in created:
+            self.stats.invalidate(d)
+            self.directories.setdefault(path.relpath(d, self.view_dir), None)
+        # The mtime of the existing parent has changed
+        self.stats.invalidate_stat(dir)
+
+    def path_format(self):
+        if self.compiled_format is None:
+            self.compiled_format = PathFormat(self.view)
+        return self.compiled_format
+
+    def prepare_checkout(self):
+        """Creates the directories for all new files and returns the links to be made."""
         if not self.view:
             raise SessionError("View does not exist")
 
-        modified_folders = set() 
-        copyrighted_files = []
+        path_format = self.path_format()
+        tasks = []
+        for file in self.new_files:
+            rel_path = path.normpath(path_format.format_file(file))
+
+            folder = path.dirname(rel_path)
+            while folder:
+                self.modified_folders.add(folder)
+                folder = path.dirname(folder)
+
+            abs_path = path.join(self.view_dir, rel_path)
+            if not self.stats.isfile(abs_path):
+                tasks.append({ "sync": self, "file": file, "rel_path": rel_path,
+                        "source": self.fetched.path(file), "target": abs_path })
+
+        # Create each directory once, parents first
+        for dir in sorted(set(path.dirname(t["target"]) for t in tasks)):
+            self.makedirs(dir)
+
+        return tasks
+
+    def link_done(self, task):
+        file = task["file"]
+        if file.copyrighted:
+            self.copyrighted_files.append(task["rel_path"])
 
-        fs_escape = lambda str: escape_file_name(str, self.view.charset, self.view.escape)
+        self.stats.syscalls["link"] += 1
+        self.stats.invalidate(task["target"])
+        self.new_checkouts.append(self.checkout_record(file.id, task["target"],
+                self.stats.lstat(task["source"])))
 
-        def format_path(tokens):
+    def finish_checkout(self):
+        self.db.set_checkouts(self.view.id, self.new_checkouts)
+        self.db.commit()
+
+        if self.new_checkouts:
+            self.update_directory_mtimes()
+
+        if self.copyrighted_files:
+            print("\n" + "-"*80)
+            print("The following files have special copyright notices:\n")
+            for file in self.copyrighted_files:
+                print("  -", file)
+            print("\nPlease make sure you have looked up, read and understood the terms and"
+                    " conditions of these files before proceeding to use them.")
+            print("-"*80 + "\n")
+
+    def update_directory_mtimes(self):
+        # Every folder within the view gets the mtime of the newest file checked out below it,
+        # which is known from the checkout records without listing the directories
+        latest = {}
+        for c in chain(self.existing.values(), self.new_checkouts):
+            folder = path.dirname(c.path)
+            while folder:
+                if folder in self.modified_folders:
+                    latest[folder] = max(latest.get(folder, 0), c.mtime)
+                folder = path.dirname(folder)
+
+        for folder, mtime in latest.items():
+            abs_dir = path.join(self.view_dir, folder)
             try:
-                return self.view.format.format(**tokens)
-            except Exception:
-                raise SessionError("Invalid path format: " + path_format)
+                os.utime(abs_dir, (mtime, mtime))
+            except OSError:
+                pass
+            self.stats.syscalls["utime"] += 1
+            self.stats.invalidate_stat(abs_dir)
 
-        try:
-            pending_files = []
-            for file in self.new_files:
-                def make_path(folders):
-                    return path.join(*map(fs_escape, folders)) if folders else ""
-
-                descr_no_ext = file.description
-                if descr_no_ext.endswith("." + file.extension):
-                    descr_no_ext = descr_no_ext[:-1-len(file.extension)]
-
-                short_path = file.path
-                if short_path[0] == "Allgemeiner Dateiordner":
-                    short_path = short_path[1:]
-
-                extension = ("." + file.extension) if file.extension else ""
-                if file.version > 0:
-                    extension = fs_escape(" (StudIP Version {})".format(file.version + 1)) \
-                            + extension
-
-                tokens = {
-                    "semester": fs_escape(file.course_semester),
-                    "semester-lexical": fs_escape(lexicalise_semester(file.course_semester)),
-                    "semester-lexical-short": fs_escape(lexicalise_semester(file.course_semester, short=True)),
-                    "course-id": file.course,
-                    "course-abbrev": fs_escape(file.course_abbrev),
-                    "course": fs_escape(file.course_name),
-                    "type": fs_escape(file.course_type),
-                    "type-abbrev": fs_escape(file.course_type_abbrev),
-                    "path": make_path(file.path),
-                    "short-path": make_path(short_path),
-                    "id": file.id,
-                    "name": fs_escape(file.name),
-                    "ext": extension,
-                    "description": fs_escape(file.description),
-                    "descr-no-ext": fs_escape(descr_no_ext),
-                    "author": fs_escape(file.author),
-                    "time": fs_escape(str(file.local_date))
-                }
-
-                rel_path = format_path(tokens)
-
-                # First update modified_folders, then create directories.
-                folder = path.dirname(rel_path)
-                while folder:
-                    modified_folders.add(folder)
-                    folder = path.dirname(folder)
-                
-                abs_path = path.join(self.view_dir, rel_path)
-                if not path.isfile(abs_path):
-                    pending_files.append((file, rel_path, abs_path))
-
-            first_file = True
-            for i, (file, rel_path, abs_path) in enumerate(pending_files):
-                if first_file:
-                    print()
-                    first_file = False
-                print("Checking out file {}/{}: {}...".format(i+1, len(pending_files),
-                        ellipsize(file.description, 50)))
-
-                if file.copyrighted:
-                    copyrighted_files.append(rel_path)
-
-                file_name = file.id
-                if file.version > 0:
-                    file_name += "." + str(file.version)
-                os.makedirs(path.dirname(abs_path), exist_ok=True)
-                os.link(path.join(self.files_dir, file_name), abs_path)
-                self.db.add_checkout(self.view.id, file.id)
-
-        finally:
-            self.db.commit()
-
-            modified_folders = list(modified_folders)
-            modified_folders.sort(key=lambda f: len(f), reverse=True)
-
-            def update_directory_mtime(dir):
-                latest_ctime = 0
-                for file in os.listdir(dir):
+        # The view's base and the sync directory can contain unmanaged files and other views
+        def update_directory_mtime(dir):
+            latest_ctime = 0
+            # This may fail if a directory has not been created yet.
+            try:
+                dirs, files = self.stats.listdir(dir)
+                for file in dirs + files:
                     if not file.startswith("."):
-                        latest_ctime = max(latest_ctime, path.getmtime(dir + "/" + file))
+                        latest_ctime = max(latest_ctime,
+                                self.stats.getmtime(path.join(dir, file)))
+                self.stats.syscalls["utime"] += 1
+                os.utime(dir, (latest_ctime, latest_ctime))
+            except Exception:
+                pass
+            # The parent directory reads the new mtime
+            self.stats.invalidate_stat(dir)
+
+        if self.view.base:
+            update_directory_mtime(self.view_dir)
+        update_directory_mtime(self.sync_dir)
+
+    def create_course_folders(self, courses):
+        """Creates course folders for all courses that do not have files yet."""
+        path_format = self.path_format()
+        for course in courses:
+            abs_path = path.join(self.view_dir, path_format.format_course(course))
 
-                # This may fail if a directory has not been created yet.
+            dir = path.dirname(abs_path)
+            if not self.stats.isdir(dir):
                 try:
-                    os.utime(dir, (latest_ctime, latest_ctime))
-                except Exception:
+                    self.makedirs(dir)
+                    print("Created folder for empty {} {}".format(course.type, course.name))
+                except OSError:
                     pass
 
-            for folder in modified_folders:
-                update_directory_mtime(path.join(self.view_dir, folder))
-            if self.view.base:
-                update_directory_mtime(self.view_dir)
-            update_directory_mtime(self.sync_dir)
-
-            if copyrighted_files:
-                print("\n" + "-"*80)
-                print("The following files have special copyright notices:\n")
-                for file in copyrighted_files:
-                    print("  -", file)
-                print("\nPlease make sure you have looked up, read and understood the terms and"
-                        " conditions of these files before proceeding to use them.")
-                print("-"*80 + "\n")
-
-        # Create course folders for all courses that do not have files yet
-        for course in self.db.list_courses(full=True, select_sync_metadata_only=False,
-                select_sync_no=False):
-            # Construct a dummy file for extracting the fromatted path
-            tokens = {
-                "semester": fs_escape(course.semester),
-                "semester-lexical": fs_escape(lexicalise_semester(course.semester)),
-                "semester-lexical-short": fs_escape(lexicalise_semester(course.semester, short=True)),
-                "course-id": course.id,
-                "course": fs_escape(course.name),
-                "course-abbrev": fs_escape(course.abbrev),
-                "type": fs_escape(course.type),
-                "type-abbrev": fs_escape(course.type_abbrev),
-                "path": "",
-                "short-path": "",
-                "id": "0" * 32,
-                "name": "dummy",
-                "ext": "txt",
-                "description": "dummy.txt",
-                "descr-no-ext": "dummy",
-                "author": "A",
-                "time": fs_escape("0000-00-00 00:00:00"),
-            }
-
-            abs_path = path.join(self.view_dir, format_path(tokens))
-
-            try:
-                os.makedirs(path.dirname(abs_path), exist_ok=False)
-                print("Created folder for empty {} {}".format(course.type, course.name))
-            except OSError: # Folder already exists
-                pass
+        self.store_directories()
+        self.db.commit()
 
 
     def remove(self):
@@ -215,16 +500,16 @@ class ViewSynchronizer:
         # Remove our files, mark directories containing foreign files
         directories = []
         directories_to_keep = []
-        for cwd, dirs, files in os.walk(self.view_dir):
-            if cwd.startswith(self.meta_dir): continue
-
+        for cwd, dirs, files in self.stats.walk(self.view_dir, prune=(self.meta_dir,)):
             has_foreign_files = False
             for lf in files:
                 # Is this file a hardlink to a file we control?
                 abs_path = os.path.join(cwd, lf)
-                inode = os.lstat(abs_path).st_ino
-                if any(f.inode == inode for f in self.existing_files):
+                st = self.stats.lstat(abs_path)
+                if (st.st_dev, st.st_ino) in self.existing_inodes:
                     os.unlink(abs_path)
+                    self.stats.syscalls["unlink"] += 1
+                    self.stats.invalidate(abs_path)
                 else:
                     has_foreign_files = True
 
@@ -239,6 +524,7 @@ class ViewSynchronizer:
         for dir in directories:
             if not any (d.startswith(dir) for d in directories_to_keep):
                 os.rmdir(dir)
+                self.stats.syscalls["rmdir"] += 1
 
         if directories_to_keep:
             print("The following directories contain unmanaged files and were kept:\n  - "
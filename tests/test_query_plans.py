@@ -0,0 +1,81 @@
+import os, re, shutil, tempfile, unittest
+
+from datetime import datetime, timedelta
+
+from studip.database import Database, Semester, Course, File, Checkout, SyncMode
+from studip.trace import QueryProfiler
+
+
+# A plan step that reads a whole table instead of searching it or walking an index
+FULL_SCAN_RE = re.compile(r"\bSCAN\b(?!.*\bUSING (COVERING )?INDEX\b)")
+
+
+class QueryPlanTest(unittest.TestCase):
+    """Checks that the queries run for every file during update and checkout use the indexes of
+    the schema instead of scanning whole tables."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="studip-test-")
+        self.db = Database(os.path.join(self.dir, "cache.sqlite"))
+
+        semester = Semester("1" * 32, "WS 16/17", 0)
+        self.db.update_semester_list([ semester ])
+        date = datetime(2016, 10, 1)
+        for c in range(3):
+            course = Course("{:032x}".format(c + 1), semester=semester.name, number=str(c),
+                    name="Course {}".format(c), type="Vorlesung", sync=SyncMode.Full)
+            self.db.add_course(course)
+            self.db.store_files([ File("{:016x}{:016x}".format(c + 1, f + 1), course=course.id,
+                    path=("Allgemeiner Dateiordner", "Folder {}".format(f % 3)),
+                    name="document{}".format(f), extension="pdf", author="Author",
+                    description="Document {}.pdf".format(f), remote_date=date,
+                    local_date=date) for f in range(10) ], [])
+            self.db.set_course_sync_time(course.id, date + timedelta(days=c))
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.conn.close()
+        shutil.rmtree(self.dir)
+
+    def assertNoFullScans(self, function):
+        """Runs function and checks the plans of all statements it executes."""
+        profiler = self.db.profiler = QueryProfiler()
+        try:
+            function()
+        finally:
+            self.db.profiler = None
+
+        # Batches without any rows were never executed and have no parameters to explain with
+        statements = [ s for s in profiler.statements.values()
+                if not s["script"] and s["params"] is not None ]
+        self.assertTrue(statements)
+        for s in statements:
+            self.assertPlanUsesIndexes(s["sql"], s["params"])
+
+    def assertPlanUsesIndexes(self, sql, params):
+        for row in self.db.explain_query(sql, params):
+            self.assertIsNone(FULL_SCAN_RE.search(row[-1]), "{}\n{}".format(row[-1], sql))
+
+    def test_file_listing(self):
+        self.assertNoFullScans(lambda: self.db.list_files(full=True,
+                select_sync_metadata_only=False, select_sync_no=False))
+        self.assertNoFullScans(lambda: dict(self.db.iter_file_rows([ "id", "remote_date" ],
+                select_sync_no=False)))
+        # Incremental updates only list the files of the courses they crawl
+        self.assertNoFullScans(lambda: dict(self.db.iter_file_rows([ "id", "remote_date" ],
+                courses=[ "1".zfill(32), "3".zfill(32) ], select_sync_no=False)))
+
+    def test_folder_lookup(self):
+        date = datetime(2017, 2, 1)
+        self.assertNoFullScans(lambda: self.db.store_files([ File("f" * 32, course="1".zfill(32),
+                path=("Allgemeiner Dateiordner", "Folder 1", "New"), name="new",
+                extension="pdf", author="Author", description="new.pdf", remote_date=date,
+                local_date=date) ], []))
+
+    def test_checkout_index(self):
+        file_ids = list(dict(self.db.iter_file_rows([ "id", "remote_date" ])))
+        self.db.set_checkouts(0, [ Checkout(id, id + ".pdf", 1, i, 0.0)
+                for i, id in enumerate(file_ids) ])
+        self.assertNoFullScans(lambda: self.db.list_checkouts(0))
+        # Run by the cleanup_checkouts_files trigger whenever a file is deleted
+        self.assertPlanUsesIndexes("DELETE FROM checkouts WHERE file = ?", (file_ids[0],))